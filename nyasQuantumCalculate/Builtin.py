@@ -5,7 +5,7 @@ __all__ = [
     # ControlMethod
     "CNOT", "CCNOT",
     # Measure
-    "M", "MA",
+    "M", "MA", "Sample",
     # QFT
     "QFT", "IQFT", "AQFT", "IAQFT",
     # Reset
@@ -1,21 +1,148 @@
 # -*- coding: utf-8 -*-
 
+from typing import Dict, List, Tuple
+
+import numpy as np
+
 from nyasQuantumCalculate.Options import *
 from nyasQuantumCalculate.Utils import *
 from nyasQuantumCalculate.System import *
 from nyasQuantumCalculate.Operate import *
+from nyasQuantumCalculate.Operate.Permute import (addRegister, adderRegister,
+                                                  rollRegister)
+from nyasQuantumCalculate.Operate.SingleQubitGate import angleName, applyPhases
 
 
 __all__ = ["Adder", "PhaseAdd", "IPhaseAdd","Add", "IAdd",
            "PhaseAddInt", "IPhaseAddInt", "AddInt", "IAddInt"]
 
 
+# 按(n, m, 常数)缓存的相位数组, 见`phaseAddTables`
+_phaseTables: Dict[Tuple[int, int, int], np.ndarray] = dict()
+
+
+def phaseTable(angles: np.ndarray) -> np.ndarray:
+    """第j个量子位为|1❭时相位增加angles[j], 得到每个基态的相位
+
+    Args:
+        angles: 每个量子位的相位, 第一个量子位为最高位
+
+    Returns:
+        长度为2^n的相位数组"""
+    n = len(angles)
+    bits = (np.arange(1 << n)[:, None] >> np.arange(n - 1, -1, -1)) & 1
+    return np.exp(1j * (bits @ angles))
+
+
+def phaseAddIntAngles(n: int, A: int, inverse: bool) -> List[float]:
+    """PhaseAddInt的位门实现里B的每个量子位上R1门的角度, 第一个为最高位"""
+    angles = list()
+    tag0 = 1 << n
+    tag1 = tag0 - 1
+    a_ = A & tag1
+    tag0 >>= 1
+    for _ in range(n):
+        angles.append(a_ / tag0 * (-pi if inverse else pi))
+        tag1 >>= 1
+        tag0 >>= 1
+        a_ &= tag1
+    return angles
+
+
+def phaseAddTables(n: int, m: int, constant: int) -> np.ndarray:
+    """得到相位加法在A和B上的相位数组
+
+    PhaseAdd里A控制的旋转门都作用在B上并且都是对角的, 合并为A和B上的一个
+    相位数组: A的第a位和B的第b位都为|1❭时相位增加angles[a, b]. m为0时A是
+    常数constant, 相位数组只在B上.
+
+    Args:
+        n: B的长度
+        m: A的长度, A是常数时为0
+        constant: A是常数时为A, 否则为1; 逆运算时取相反数
+
+    Returns:
+        长度为2^(m+n)的相位数组, A在高位, 第一个量子位为最高位"""
+    key = (n, m, constant)
+    table = _phaseTables.get(key)
+    if table is not None:
+        return table
+    if m:
+        sign = -1. if constant < 0 else 1.
+        angles = np.zeros((m, n))
+        for a in range(m):
+            for b in range(n):
+                # 与PhaseAdd的位门实现相同, A_[a]控制B_[b]上的R_{e+1}
+                e = a + n - m - b
+                if e >= 0:
+                    angles[a, b] = sign * pi / (1 << e)
+        bitsA = (np.arange(1 << m)[:, None] >> np.arange(m - 1, -1, -1)) & 1
+        bitsB = (np.arange(1 << n)[:, None] >> np.arange(n - 1, -1, -1)) & 1
+        table = np.exp(1j * (bitsA @ angles @ bitsB.T)).reshape(-1)
+    else:
+        table = phaseTable(
+            np.array(phaseAddIntAngles(n, abs(constant), constant < 0)))
+    if len(_phaseTables) > 256:
+        _phaseTables.clear()
+    _phaseTables[key] = table
+    return table
+
+
+def phaseAdd(A: Qubits, B: Qubits, inverse: bool) -> None:
+    """PhaseAdd和IPhaseAdd的实现, A和B已经按高位在前排列
+
+    所有受控旋转门合并为A和B上的一次相位乘法, 跟踪器里仍然记录每一个受控
+    旋转门."""
+    m = len(A)
+    n = len(B)
+    if m == 0 or n == 0:
+        return
+    qbsys = B.system
+    if Options.inputCheck and any(isControllingQubits(B)):
+        raise ValueError("受控过程作用在控制位上")
+    if any(isControllingQubits(A)):
+        # 与位门实现相同, A的量子位会作为控制位
+        raise ValueError("Controlling bit is added repeatedly.")
+    if qbsys.canTrack():
+        gates = RotationGates.iRs if inverse else RotationGates.Rs
+        n_m = n - m
+        for index in range(n):
+            A_start = max(0, index - n_m)
+            B_start = max(0, n_m - index)
+            B_end = n - index
+            for ctlQb, target in zip(A[A_start:], B[B_start:B_end]):
+                qbsys.addControllingQubits(ctlQb.index)
+                qbsys.addTrack(gates[index].name, target.index)
+                qbsys.popControllingQubits()
+    table = phaseAddTables(n, m, -1 if inverse else 1)
+    applyPhases(qbsys, [*A.indexes, *B.indexes], table)
+
+
+def phaseAddInt(A: int, B: Qubits, inverse: bool) -> None:
+    """PhaseAddInt和IPhaseAddInt的实现, B已经按高位在前排列
+
+    只需要一次相位乘法, 跟踪器里仍然记录每一个相位门."""
+    n = len(B)
+    if n == 0:
+        return
+    qbsys = B.system
+    if Options.inputCheck and any(isControllingQubits(B)):
+        raise ValueError("受控过程作用在控制位上")
+    a_ = A & ((1 << n) - 1)
+    table = phaseAddTables(n, 0, -a_ if inverse else a_)
+    if qbsys.canTrack():
+        for qb, angle in zip(B, phaseAddIntAngles(n, a_, inverse)):
+            qbsys.addTrack(f"R1({angleName(angle)})", qb.index)
+    applyPhases(qbsys, B.indexes, table)
+
+
 def Adder(Cin: Qubit, A: Qubits, B: Qubits, Cout: Qubit) -> None:
     """基本加法器
 
     |Cin❭|A❭|B❭|Cout❭ -> |Cin❭|A❭|mod(A+B,N)❭|Cout⊕floor(A+B/N)❭; N = 2^n
 
-    注意: 使用可逆计算逻辑运行的加法器, 中途会新增n-1个Qubits, 确保有足够的内存
+    注意: 使用可逆计算逻辑运行的加法器, 中途会新增n-1个Qubits, 确保有足够的内存.
+    Options.addByPermutation开启并且跟踪关闭时, 直接置换基态, 不需要新增量子位
 
     Args:
         Cin: 进位输入
@@ -28,6 +155,14 @@ def Adder(Cin: Qubit, A: Qubits, B: Qubits, Cout: Qubit) -> None:
         if len(A) != len(B):
             raise ValueError("Length of A and B should be same.")
     n = len(A)
+    qbsys = Cin.system
+    if Options.addByPermutation and not qbsys.canTrack():
+        if Options.inputCheck and any(isControllingQubits(Cin, A, B, Cout)):
+            raise ValueError("Controlled process operates controlling bit.")
+        A_ = A[::-1] if Options.littleEndian else A
+        B_ = B[::-1] if Options.littleEndian else B
+        adderRegister(qbsys, Cin.index, A_.indexes, B_.indexes, Cout.index)
+        return
     A_ = A if Options.littleEndian else A[::-1]
     B_ = B if Options.littleEndian else B[::-1]
     with TemporaryQubits(Cin.system, n - 1) as tmp:
@@ -66,18 +201,10 @@ def PhaseAdd(A: Qubits, B: Qubits) -> None:
             raise ValueError("Input qubits are not in same system.")
         if len(A) > len(B):
             raise ValueError("Length of A should not be greater than B's.")
-    m = len(A)
-    n = len(B)
-    n_m = n - m
-    RotationGates.updateRs(n)
+    RotationGates.updateRs(len(B))
     A_ = A[::-1] if Options.littleEndian else A
     B_ = B[::-1] if Options.littleEndian else B
-    for index in range(n):
-        A_start = max(0, index - n_m)
-        B_start = max(0, n_m - index)
-        B_end = n - index
-        for ctlQb, target in zip(A_[A_start:], B_[B_start:B_end]):
-            Controlled(RotationGates.Rs[index], ctlQb.asQubits(), target)
+    phaseAdd(A_, B_, False)
 
 
 def Add(A: Qubits, B: Qubits) -> None:
@@ -85,6 +212,8 @@ def Add(A: Qubits, B: Qubits) -> None:
 
     |A❭|B❭ -> |A❭|mod(A+B,N)❭; N = 2^n
 
+    Options.addByPermutation开启并且跟踪关闭时, 直接置换A和B的基态
+
     Args:
         A: 加数, 长度为m
         B: 被加数, 长度为n, 并且n>=m"""
@@ -95,6 +224,11 @@ def Add(A: Qubits, B: Qubits) -> None:
             raise ValueError("Length of A should not be greater than B's.")
     A_ = A[::-1] if Options.littleEndian else A
     B_ = B[::-1] if Options.littleEndian else B
+    if Options.addByPermutation and not B.system.canTrack():
+        if Options.inputCheck and any(isControllingQubits(A, B)):
+            raise ValueError("Controlled process operates controlling bit.")
+        addRegister(B.system, A_.indexes, B_.indexes, False)
+        return
     with TemporaryOptions.QFTswap(False):
         QFT(B_)
         with (TemporaryOptions.inputCheck(False),
@@ -114,18 +248,10 @@ def IPhaseAdd(A: Qubits, B: Qubits) -> None:
             raise ValueError("Input qubits are not in same system.")
         if len(A) > len(B):
             raise ValueError("Length of A should not be greater than B's.")
-    m = len(A)
-    n = len(B)
-    n_m = n - m
-    RotationGates.updateiRs(n)
+    RotationGates.updateiRs(len(B))
     A_ = A[::-1] if Options.littleEndian else A
     B_ = B[::-1] if Options.littleEndian else B
-    for index in range(n):
-        A_start = max(0, index - n_m)
-        B_start = max(0, n_m - index)
-        B_end = n - index
-        for ctlQb, target in zip(A_[A_start:], B_[B_start:B_end]):
-            Controlled(RotationGates.iRs[index], ctlQb.asQubits(), target)
+    phaseAdd(A_, B_, True)
 
 
 def IAdd(A: Qubits, B: Qubits) -> None:
@@ -133,6 +259,8 @@ def IAdd(A: Qubits, B: Qubits) -> None:
 
     |A❭|A+B❭ -> |A❭|mod(B,N)❭; N = 2^n
 
+    Options.addByPermutation开启并且跟踪关闭时, 直接置换A和B的基态
+
     Args:
         A: 加数, 长度为m
         B: 被加数, 长度为n, 并且n>=m"""
@@ -143,6 +271,11 @@ def IAdd(A: Qubits, B: Qubits) -> None:
             raise ValueError("Length of A should not be greater than B's.")
     A_ = A[::-1] if Options.littleEndian else A
     B_ = B[::-1] if Options.littleEndian else B
+    if Options.addByPermutation and not B.system.canTrack():
+        if Options.inputCheck and any(isControllingQubits(A, B)):
+            raise ValueError("Controlled process operates controlling bit.")
+        addRegister(B.system, A_.indexes, B_.indexes, True)
+        return
     with TemporaryOptions.QFTswap(False):
         QFT(B_)
         with (TemporaryOptions.inputCheck(False),
@@ -157,17 +290,8 @@ def PhaseAddInt(A: int, B: Qubits) -> None:
     Args:
         A: 加数, 长度小于等于n, 否则会被截断
         B: 被加数, 长度为n"""
-    n = len(B)
-    tag0 = 1 << n
-    tag1 = tag0 - 1
-    a_ = A & tag1
     B_ = B[::-1] if Options.littleEndian else B
-    tag0 >>= 1
-    for qb in B_:
-        R1(a_ / tag0 * pi)(qb)
-        tag1 >>= 1
-        tag0 >>= 1
-        a_ &= tag1
+    phaseAddInt(A, B_, False)
 
 
 def AddInt(A: int, B: Qubits) -> None:
@@ -175,12 +299,18 @@ def AddInt(A: int, B: Qubits) -> None:
 
     |B❭ -> |mod(A+B,N)❭; N = 2^n
 
-    因为加数不是量子位, 使用化简算法
+    因为加数不是量子位, 使用化简算法. Options.addByPermutation开启并且跟踪
+    关闭时, 直接循环置换B的基态
 
     Args:
         A: 加数, 长度小于等于n, 否则会被截断
         B: 被加数, 长度为n"""
     B_ = B[::-1] if Options.littleEndian else B
+    if Options.addByPermutation and not B.system.canTrack():
+        if Options.inputCheck and any(isControllingQubits(B)):
+            raise ValueError("Controlled process operates controlling bit.")
+        rollRegister(B.system, B_.indexes, A)
+        return
     with TemporaryOptions.QFTswap(False):
         QFT(B_)
         with TemporaryOptions.littleEndian(False):
@@ -194,17 +324,8 @@ def IPhaseAddInt(A: int, B: Qubits) -> None:
     Args:
         A: 加数, 长度小于等于n, 否则会被截断
         B: 被加数, 长度为n"""
-    n = len(B)
-    tag0 = 1 << n
-    tag1 = tag0 - 1
-    a_ = A & tag1
     B_ = B[::-1] if Options.littleEndian else B
-    tag0 >>= 1
-    for qb in B_:
-        R1(a_ / tag0 * -pi)(qb)
-        tag1 >>= 1
-        tag0 >>= 1
-        a_ &= tag1
+    phaseAddInt(A, B_, True)
 
 
 def IAddInt(A: int, B: Qubits) -> None:
@@ -212,14 +333,20 @@ def IAddInt(A: int, B: Qubits) -> None:
 
     |A+B❭ -> |mod(B,N)❭; N = 2^n
 
-    因为加数不是量子位, 使用化简算法
+    因为加数不是量子位, 使用化简算法. Options.addByPermutation开启并且跟踪
+    关闭时, 直接循环置换B的基态
 
     Args:
         A: 加数, 长度小于等于n, 否则会被截断
         B: 被加数, 长度为n"""
     B_ = B[::-1] if Options.littleEndian else B
+    if Options.addByPermutation and not B.system.canTrack():
+        if Options.inputCheck and any(isControllingQubits(B)):
+            raise ValueError("Controlled process operates controlling bit.")
+        rollRegister(B.system, B_.indexes, -A)
+        return
     with TemporaryOptions.QFTswap(False):
         QFT(B_)
         with TemporaryOptions.littleEndian(False):
-            PhaseAddInt(A, B_)
+            IPhaseAddInt(A, B_)
         IQFT(B_)
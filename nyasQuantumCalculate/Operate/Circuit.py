@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from itertools import product
+
+import numpy as np
+
+from .Measure import measureQubit, measureQubits
+from .Permute import addRegister, adderRegister, rollRegister
+from .QFT import aqftRegister, fftRegister
+from .Reset import resetQubit, resetQubits
+from .Swap import swapQubits
+from .SingleQubitGate import (SingleQubitGate, _applyDiagonal, _kernels,
+                              applyPhases)
+from nyasQuantumCalculate.Options import *
+from nyasQuantumCalculate.System import *
+
+
+__all__ = ["Circuit", "CaptureCircuit"]
+
+
+class Circuit:
+    """Circuit(int)
+
+    录制下来的量子位操作序列, 可以在任意足够大的量子位系统上重放. 重放时不
+    经过量子位过程的包装, 输入检查和Qubit对象, 直接在系统的状态上作用.
+    录制时新增的临时量子位在系统的末端, 在更大的系统上重放时会重新编号为
+    重放时实际新增的量子位, 见`resized`.
+
+    操作以紧凑的数组储存, 每个操作的参数为 [参数, 控制位数, *控制位, *作用位],
+    位门的参数是它在matrices里的索引, 需要值为0的控制位ctl储存为~ctl(负数).
+    录制时的经典分支(比如根据测量结果选择位门)不会被录制, 重放时总是作用
+    相同的操作序列.
+
+    Attributes:
+        nQubits: 重放时系统至少需要的量子位数量
+        codes: 每个操作的操作码, 为`Circuit.opcodes`的索引
+        args: 所有操作的参数连接成的数组
+        offsets: 第i个操作的参数为 args[offsets[i]:offsets[i+1]]
+        matrices: 位门的矩阵, 形状为 [位门数, 2, 2]
+        kinds: 位门矩阵的种类, 为`Circuit.kindNames`的索引
+        normErrors: 位门的归一化误差
+        phaseTables: 对角矩阵(PHASES操作)的相位数组, 见`applyPhases`
+        tracker: 录制时系统跟踪到的条目, 重放时会添加到系统的跟踪器里
+    """
+    opcodes = ("GATE", "SWAP", "MEASURE", "MEASUREALL", "RESET", "RESETALL",
+               "FFT", "ADDQUBITS", "POPQUBITS", "AQFT", "PHASES",
+               "ROLL", "ADD", "ADDER")
+    kindNames = ("identity", "diagonal", "antidiagonal", "real", "general")
+
+    def __init__(self, nQubits: int = 0) -> None:
+        self.nQubits = nQubits
+        self.codes = np.zeros(0, np.int8)
+        self.args = np.zeros(0, np.int64)
+        self.offsets = np.zeros(1, np.int64)
+        self.matrices = np.zeros((0, 2, 2), np.complex128)
+        self.kinds = np.zeros(0, np.int8)
+        self.normErrors = np.zeros(0, np.float64)
+        self.phaseTables: List[np.ndarray] = list()
+        self.tracker: List[Tuple[Tuple[int, ...],
+                                 Tuple[int, ...], str]] = list()
+        # 录制中还没有合并到数组里的操作和位门
+        self._newOps: List[Tuple[int, List[int]]] = list()
+        self._newGates: List[Tuple[np.ndarray, int, float]] = list()
+        self._programs: Dict[np.dtype, List[Tuple[Any, ...]]] = dict()
+        self._resized: Dict[int, "Circuit"] = dict()
+
+    def __len__(self) -> int:
+        return len(self.codes) + len(self._newOps)
+
+    def __repr__(self) -> str:
+        return f"Circuit({len(self)} operations)"
+
+    @property
+    def isReal(self) -> bool:
+        """重放时是否不需要把系统转为复数"""
+        self.compile()
+        return not np.any(self.matrices.imag) and \
+            self.opcodes.index("FFT") not in self.codes and \
+            self.opcodes.index("AQFT") not in self.codes and \
+            not any(np.any(table.imag) for table in self.phaseTables)
+
+    def addOperation(self, name: str, ctls: Tuple[int, ...],
+                     idxs: Tuple[int, ...], param: int = 0,
+                     values: Optional[Tuple[bool, ...]] = None) -> None:
+        """在末端添加操作
+
+        Args:
+            name: 操作的名字, 必须在`Circuit.opcodes`里
+            ctls: 控制位的索引
+            idxs: 作用位的索引
+            param: 操作的参数, 比如FFT是否为逆变换, 增加量子位的数量, AQFT
+                的m(逆变换时为-m), ROLL的加数, ADD里A的长度(减法时为负数)
+            values: 每个控制位需要的值, 默认全部为True"""
+        if values is not None:
+            ctls = tuple(ctl if value else ~ctl
+                         for ctl, value in zip(ctls, values))
+        self._newOps.append((self.opcodes.index(name),
+                             [param, len(ctls), *ctls, *idxs]))
+
+    def addGate(self, gate: SingleQubitGate, ctls: Tuple[int, ...],
+                idx: int, values: Optional[Tuple[bool, ...]] = None) -> None:
+        """在末端添加(受控)单量子位门
+
+        Args:
+            gate: 单量子位门, 会复制它当前的矩阵
+            ctls: 控制位的索引
+            idx: 目标位的索引
+            values: 每个控制位需要的值, 默认全部为True"""
+        if gate.matrix.ndim > 2:
+            raise ValueError("Gates with per-member parameters cannot be "
+                             "captured.")
+        nGates = len(self.kinds) + len(self._newGates)
+        self._newGates.append((gate.matrix.copy(),
+                               self.kindNames.index(gate.kind),
+                               gate.normError))
+        self.addOperation("GATE", ctls, (idx,), nGates, values)
+
+    def addPhases(self, phases: np.ndarray, ctls: Tuple[int, ...],
+                  idxs: Tuple[int, ...],
+                  values: Optional[Tuple[bool, ...]] = None) -> None:
+        """在末端添加对角矩阵, 见`applyPhases`
+
+        Args:
+            phases: 相位数组, 会被复制
+            ctls: 控制位的索引
+            idxs: 作用位的索引
+            values: 每个控制位需要的值, 默认全部为True"""
+        self.phaseTables.append(np.array(phases, np.complex128))
+        self.addOperation("PHASES", ctls, idxs, len(self.phaseTables) - 1,
+                          values)
+
+    def extend(self, other: "Circuit") -> None:
+        """在末端添加另一个Circuit的全部操作(不包括跟踪条目)
+
+        nQubits取两者中较大的一个, other新增的临时量子位应该不小于
+        self.nQubits, 比如在录制过程中嵌套录制, 见`resized`"""
+        other.compile()
+        self.nQubits = max(self.nQubits, other.nQubits)
+        nGates = len(self.kinds) + len(self._newGates)
+        self._newGates += [(m, kind, error) for m, kind, error in
+                           zip(other.matrices, other.kinds, other.normErrors)]
+        nTables = len(self.phaseTables)
+        self.phaseTables += other.phaseTables
+        gateCode = self.opcodes.index("GATE")
+        phasesCode = self.opcodes.index("PHASES")
+        for code, args in zip(other.codes.tolist(), other.operationArgs()):
+            if code == gateCode:
+                args[0] += nGates
+            elif code == phasesCode:
+                args[0] += nTables
+            self._newOps.append((code, args))
+
+    def compile(self) -> None:
+        """把录制中的操作合并到紧凑的数组里"""
+        if not self._newOps:
+            return
+        codes, args = zip(*self._newOps)
+        lengths = np.array([len(arg) for arg in args], np.int64)
+        self.codes = np.concatenate([self.codes, np.array(codes, np.int8)])
+        self.args = np.concatenate([self.args, np.fromiter(
+            (i for arg in args for i in arg), np.int64, int(lengths.sum()))])
+        self.offsets = np.concatenate(
+            [self.offsets, self.offsets[-1] + np.cumsum(lengths)])
+        if self._newGates:
+            matrices, kinds, errors = zip(*self._newGates)
+            self.matrices = np.concatenate([self.matrices, np.array(
+                matrices, np.complex128).reshape([-1, 2, 2])])
+            self.kinds = np.concatenate([self.kinds, np.array(kinds, np.int8)])
+            self.normErrors = np.concatenate(
+                [self.normErrors, np.array(errors, np.float64)])
+        self._newOps.clear()
+        self._newGates.clear()
+        self._programs.clear()
+        self._resized.clear()
+
+    def resized(self, nQubits: int) -> "Circuit":
+        """得到在有nQubits个量子位的系统上重放的Circuit
+
+        索引不小于self.nQubits的量子位是录制时新增的临时量子位, 重放时它们
+        从系统的末端开始分配, 所以这些索引平移nQubits-self.nQubits, 其他
+        索引不变. 结果按nQubits缓存.
+
+        Args:
+            nQubits: 重放时系统的量子位数量, 不能小于self.nQubits
+
+        Returns:
+            新的Circuit, 与原来共享位门矩阵, 相位数组和置换"""
+        self.compile()
+        if nQubits == self.nQubits:
+            return self
+        circuit = self._resized.get(nQubits)
+        if circuit is not None:
+            return circuit
+        n0 = self.nQubits
+        shift = nQubits - n0
+
+        def remap(idx: int) -> int:
+            if idx < 0:
+                return ~remap(~idx)
+            return idx + shift if idx >= n0 else idx
+
+        circuit = Circuit(nQubits)
+        circuit.codes = self.codes
+        circuit.offsets = self.offsets
+        circuit.args = np.array(
+            [arg for args in self.operationArgs()
+             for arg in (*args[:2], *map(remap, args[2:]))], np.int64)
+        circuit.matrices = self.matrices
+        circuit.kinds = self.kinds
+        circuit.normErrors = self.normErrors
+        circuit.phaseTables = self.phaseTables
+        circuit.tracker = [(tuple(map(remap, ctls)), tuple(map(remap, idxs)),
+                            name) for ctls, idxs, name in self.tracker]
+        self._resized[nQubits] = circuit
+        return circuit
+
+    def operationArgs(self) -> Iterator[List[int]]:
+        """按顺序返回每个操作的参数列表"""
+        self.compile()
+        args = self.args.tolist()
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield args[start:end]
+
+    def getProgram(self, dtype: Any) -> List[Tuple[Any, ...]]:
+        """得到重放时使用的操作列表
+
+        位门的矩阵会预先转换为系统的类型, 并选择好相应的核.
+
+        Args:
+            dtype: 系统的类型
+
+        Returns:
+            每项为 (操作码, 参数, 控制位, 控制位的值, 作用位), 位门的参数为
+            (核, 矩阵, 归一化误差), 对角矩阵的参数为相位数组"""
+        dtype = np.dtype(dtype)
+        program = self._programs.get(dtype)
+        if program is not None:
+            return program
+        matrices = self.matrices
+        if dtype.kind == "f":
+            matrices = matrices.real
+        matrices = matrices.astype(dtype)
+        gateCode = self.opcodes.index("GATE")
+        phasesCode = self.opcodes.index("PHASES")
+        program = list()
+        for code, args in zip(self.codes.tolist(), self.operationArgs()):
+            param, nCtls = args[:2]
+            encoded = args[2:2 + nCtls]
+            ctls = tuple(ctl if ctl >= 0 else ~ctl for ctl in encoded)
+            values = tuple(ctl >= 0 for ctl in encoded)
+            idxs = args[2 + nCtls:]
+            if code == gateCode:
+                kind = self.kindNames[self.kinds[param]]
+                kernel = None if kind == "identity" else _kernels[kind]
+                param = (kernel, matrices[param],
+                         float(self.normErrors[param]))
+            elif code == phasesCode:
+                param = self.phaseTables[param]
+            program.append((code, param, ctls, values, idxs))
+        self._programs[dtype] = program
+        return program
+
+    def replay(self, qbsys: QubitsSystem) -> List[bool]:
+        """在系统上重放全部操作
+
+        除了系统的大小和控制位外不检查输入. `Options.localityWindow`大于0时,
+        在开始和受控块的边界按接下来的操作重新排列轴, 见`QubitsSystem.relayout`.
+
+        Args:
+            qbsys: 量子位系统
+
+        Returns:
+            按顺序每次测量的结果"""
+        if qbsys.nQubits < self.nQubits:
+            raise ValueError(f"The circuit needs {self.nQubits} qubits.")
+        if qbsys.nControllingQubits:
+            raise ValueError("Cannot replay a circuit under controlling "
+                             "qubits.")
+        self.compile()
+        if qbsys.nQubits != self.nQubits and \
+                self.opcodes.index("ADDQUBITS") in self.codes:
+            return self.resized(qbsys.nQubits).replay(qbsys)
+        qbsys.flushGates()
+        if not self.isReal:
+            qbsys.toComplex()
+        program = self.getProgram(qbsys.dtype)
+        recorder, qbsys.recorder = qbsys.recorder, None
+        window = Options.localityWindow
+        nextPlan = 0
+        lastCtls: Tuple[int, ...] = ()
+        blocked = Options.blockQubits > 0
+        gates: List[Tuple[Any, ...]] = list()
+        result: List[bool] = list()
+        for k, (code, param, ctls, values, idxs) in enumerate(program):
+            # 在受控块的边界按接下来的window个操作重新排列轴
+            if window and k >= nextPlan and (k == 0 or ctls != lastCtls):
+                qbsys.relayout([idx for op in program[k:k + window]
+                                for idx in op[4]])
+                nextPlan = k + window
+            lastCtls = ctls
+            if code == 0 and blocked:
+                gates.append((*param, ctls, values, idxs[0]))
+                continue
+            if gates:
+                applyBlocked(qbsys, gates)
+                gates = list()
+            if code == 0:       # GATE
+                kernel, m, error = param
+                if kernel is not None:
+                    applyKernel(qbsys, kernel, m, ctls, values, idxs[0])
+                qbsys.afterUnitary(error)
+            elif code == 1:     # SWAP
+                swapQubits(qbsys, *idxs)
+            elif code == 2:     # MEASURE
+                result.append(measureQubit(qbsys, idxs[0]))
+            elif code == 3:     # MEASUREALL
+                result += measureQubits(qbsys, idxs)
+            elif code == 4:     # RESET
+                resetQubit(qbsys, idxs[0])
+            elif code == 5:     # RESETALL
+                resetQubits(qbsys, idxs)
+            elif code == 6:     # FFT
+                if ctls:
+                    qbsys.addControllingQubits(*ctls, values=values)
+                fftRegister(qbsys, idxs, bool(param))
+                if ctls:
+                    qbsys.popControllingQubits()
+            elif code == 7:     # ADDQUBITS
+                qbsys.addQubits(param)
+            elif code == 8:     # POPQUBITS
+                qbsys.popQubits(param)
+            elif code == 9:     # AQFT
+                if ctls:
+                    qbsys.addControllingQubits(*ctls, values=values)
+                aqftRegister(qbsys, idxs, abs(param), param < 0)
+                if ctls:
+                    qbsys.popControllingQubits()
+            elif code == 10:    # PHASES
+                if ctls:
+                    qbsys.addControllingQubits(*ctls, values=values)
+                applyPhases(qbsys, idxs, param)
+                if ctls:
+                    qbsys.popControllingQubits()
+            elif code == 11:    # ROLL
+                if ctls:
+                    qbsys.addControllingQubits(*ctls, values=values)
+                rollRegister(qbsys, idxs, param)
+                if ctls:
+                    qbsys.popControllingQubits()
+            elif code == 12:    # ADD
+                if ctls:
+                    qbsys.addControllingQubits(*ctls, values=values)
+                m = abs(param)
+                addRegister(qbsys, idxs[:m], idxs[m:], param < 0)
+                if ctls:
+                    qbsys.popControllingQubits()
+            else:               # ADDER
+                if ctls:
+                    qbsys.addControllingQubits(*ctls, values=values)
+                n = (len(idxs) - 2) // 2
+                adderRegister(qbsys, idxs[0], idxs[1:n + 1], idxs[n + 1:-1],
+                              idxs[-1])
+                if ctls:
+                    qbsys.popControllingQubits()
+        if gates:
+            applyBlocked(qbsys, gates)
+        qbsys.recorder = recorder
+        if recorder is not None:
+            recorder.extend(self)
+        if qbsys.canTrack():
+            qbsys.getTracker().extend(self.tracker)
+        return result
+
+
+def applyKernel(qbsys: QubitsSystem, kernel: Any, m: np.ndarray,
+                ctls: Tuple[int, ...], values: Tuple[bool, ...],
+                idx: int) -> None:
+    """把(受控)单量子位门的核作用到整个系统上, 不处理归一化"""
+    qbsys.applyKernel(kernel, m, *qbsys.splitStatesAt(idx, ctls, values))
+
+
+def applyBlocked(qbsys: QubitsSystem, gates: List[Tuple[Any, ...]]) -> None:
+    """分块作用一串位门, 见`Options.blockQubits`
+
+    statesNd在最后blockQubits个轴以外的每一种取值都是连续的一块, 目标位都在
+    这些轴上的一串位门可以一块接一块地作用, 每一块在缓存里作用完全部位门后
+    才处理下一块, 整个系统只需要从内存读写一次. 控制位在前面的轴上时只作用
+    在控制位符合的块上, 对角的位门(如Rz, T)的目标位在前面的轴上时只需要把
+    整块乘以相应的对角元.
+
+    位门按顺序分为(不对角的位门的)目标位不超过blockQubits个的若干段. 一段的目标位不全在最后
+    的轴上时, 先用`QubitsSystem.compactStates`把它们移到最后的轴上, 位门太少
+    不值得移动数据的段直接逐个作用.
+
+    Args:
+        qbsys: 量子位系统
+        gates: 每项为 (核, 矩阵, 归一化误差, 控制位, 控制位的值, 目标位)"""
+    nLow = Options.blockQubits
+    segments: List[List[Tuple[Any, ...]]] = list()
+    targets: Set[int] = set()
+    for gate in gates:
+        if gate[0] is _applyDiagonal:
+            new = targets
+        else:
+            new = targets | {gate[5]}
+        if not segments or len(new) > nLow:
+            segments.append(list())
+            new = set() if gate[0] is _applyDiagonal else {gate[5]}
+        segments[-1].append(gate)
+        targets = new
+    for segment in segments:
+        applySegment(qbsys, segment, nLow)
+    qbsys.afterUnitary(sum(gate[2] for gate in gates), len(gates))
+
+
+def applySegment(qbsys: QubitsSystem, segment: List[Tuple[Any, ...]],
+                 nLow: int) -> None:
+    """分块作用目标位不超过nLow个的一段位门, 不处理归一化, 见`applyBlocked`"""
+    nHigh = qbsys.nQubits - nLow
+    targets = {gate[5] for gate in segment if gate[0] is not _applyDiagonal}
+    nBatch = qbsys.statesNd.ndim - qbsys.nQubits
+    if nHigh <= 0 or min([qbsys.statesNdIndex(idx) for idx in targets],
+                         default=qbsys.statesNd.ndim) < nBatch + nHigh:
+        # 移动数据的代价大约相当于几次位门
+        if nHigh <= 0 or len(segment) < 4:
+            for kernel, m, _, ctls, values, idx in segment:
+                if kernel is not None:
+                    applyKernel(qbsys, kernel, m, ctls, values, idx)
+            return
+        order = qbsys.axisOrder()
+        qbsys.compactStates([idx for idx in order if idx not in targets] +
+                            [idx for idx in order if idx in targets])
+    nHigh += nBatch
+    prepared = list()
+    for kernel, m, _, ctls, values, idx in segment:
+        if kernel is None:
+            continue
+        highCtls = list()
+        index: List[Any] = [slice(None)] * nLow
+        for ctl, value in zip(ctls, values):
+            axis = qbsys.statesNdIndex(ctl)
+            if axis < nHigh:
+                highCtls.append((axis, int(value)))
+            else:
+                index[axis - nHigh] = slice(int(value), int(value) + 1)
+        axis = qbsys.statesNdIndex(idx)
+        if axis < nHigh:
+            # 只有对角的位门的目标位会在前面的轴上
+            prepared.append((None, m, highCtls, (*index, ...), axis))
+            continue
+        index[axis - nHigh] = 0
+        index0 = (*index, ...)
+        index[axis - nHigh] = 1
+        prepared.append((kernel, m, highCtls, index0, (*index, ...)))
+    states = qbsys.statesNd
+
+    def applyBlock(block: Tuple[int, ...]) -> None:
+        chunk = states.__getitem__(block)
+        for kernel, m, highCtls, index0, index1 in prepared:
+            if not all(block[axis] == value for axis, value in highCtls):
+                continue
+            if kernel is not None:
+                kernel(m, chunk.__getitem__(index0),
+                       chunk.__getitem__(index1), qbsys)
+            elif m[block[index1], block[index1]] != 1.:
+                view = chunk.__getitem__(index0)
+                view *= m[block[index1], block[index1]]
+
+    # 各块互不依赖, Options.nThreads大于1时同时作用
+    qbsys.parallelMap(applyBlock, list(product(
+        *(range(length) for length in states.shape[:nHigh]))))
+
+
+class CaptureCircuit:
+    """CaptureCircuit(QubitsSystem)
+
+    配合with语句录制系统经历的操作, 返回`Circuit`对象. 录制时操作照常作用在
+    系统上. 嵌套录制时, 内层录制到的操作也会添加到外层.
+
+    To use:
+    >>> qbsys = QubitsSystem(2)
+    >>> q0, q1 = qbsys.getQubits()
+    >>> with CaptureCircuit(qbsys) as circuit:
+    ...     H(q0)
+    ...     CNOT(q0, q1)
+    ...     MA(qbsys.getQubits())
+    ...
+    [True, True]
+    >>> RA(qbsys.getQubits())
+    >>> circuit.replay(qbsys)
+    [False, False]
+    """
+
+    def __init__(self, qbsys: QubitsSystem) -> None:
+        self.system = qbsys
+        self.circuit = Circuit(qbsys.nQubits)
+
+    def __enter__(self) -> Circuit:
+        self.outer = self.system.recorder
+        self.start = len(self.system.getTracker())
+        self.system.recorder = self.circuit
+        return self.circuit
+
+    def __exit__(self, *error: Any) -> None:
+        self.system.recorder = self.outer
+        self.circuit.compile()
+        self.circuit.tracker = self.system.getTracker()[self.start:]
+        if self.outer is not None:
+            self.outer.extend(self.circuit)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from nyasQuantumCalculate.Options import Options
-from typing import Any, Callable, Iterable, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, \
+    Union
 
 from .QubitsOperation import *
 from .SingleQubitGate import *
@@ -25,10 +26,19 @@ def Controlled(opr: Union[OperationLike, Callable[[Any], Any]], ctlQbs: Qubits,
 
     Returns:
         opr返回的值"""
+    return controlledOnValues(opr, None, ctlQbs, args, kwargs)
+
+
+def controlledOnValues(opr: OperationLike, values: Optional[List[bool]],
+                       ctlQbs: Qubits, args: Tuple[Any, ...],
+                       kwargs: Dict[str, Any]) -> Any:
+    """在控制位符合values时作用过程opr, values为None时全部为True"""
     operation = QubitsOperation.getOperation(opr)
     if isinstance(operation, QubitsOperation) and not operation.controllable:
         raise ValueError("Target process is uncontrollable.")
-    ctlQbs.system.addControllingQubits(*ctlQbs.indexes)
+    if Options.localityWindow:
+        ctlQbs.system.planLayout()
+    ctlQbs.system.addControllingQubits(*ctlQbs.indexes, values=values)
     result = operation(*args, **kwargs)
     ctlQbs.system.popControllingQubits()
     return result
@@ -51,13 +61,21 @@ def ControlledOnBools(opr: OperationLike, bools: Iterable[bool], ctlQbs: Qubits,
     Returns:
         opr返回的值
     """
-    for bit, qubit in zip(bools, ctlQbs):
-        if not bit:
-            X(qubit)
-    result = Controlled(opr, ctlQbs, *args, **kwargs)
-    for bit, qubit in zip(bools, ctlQbs):
-        if not bit:
-            X(qubit)
+    values = [bool(bit) for bit, _ in zip(bools, ctlQbs)]
+    values += [True] * (len(ctlQbs) - len(values))
+    # 控制位直接选择值为0的部分, 不需要在前后作用X门, 但跟踪器里仍然记录
+    # 等价的X门
+    qbsys = ctlQbs.system
+    track = qbsys.canTrack() and X.trackable
+    zeros = [qubit.index for value, qubit in zip(values, ctlQbs)
+             if not value]
+    if track:
+        for idx in zeros:
+            qbsys.addTrack(X.name, idx)
+    result = controlledOnValues(opr, values, ctlQbs, args, kwargs)
+    if track:
+        for idx in zeros:
+            qbsys.addTrack(X.name, idx)
     return result
 
 
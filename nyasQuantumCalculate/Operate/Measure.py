@@ -1,15 +1,150 @@
 # -*- coding: utf-8 -*-
 
-from typing import List
+from typing import Any, List
 
 import numpy as np
 
 from .QubitsOperation import *
+from nyasQuantumCalculate.Options import *
 from nyasQuantumCalculate.Utils import *
 from nyasQuantumCalculate.System import *
 
 
-__all__ = ["M", "MA"]
+__all__ = ["M", "MA", "Sample"]
+
+
+def measureMembers(qbsys: QubitsSystem, idx: int,
+                   renormalize: bool) -> np.ndarray:
+    """在有成员的轴的系统里测量每个成员的一个量子位
+
+    Args:
+        qbsys: 量子位系统
+        idx: 量子位的索引
+        renormalize: 为True时按每个成员测得结果的概率归一化
+
+    Returns:
+        每个成员的结果组成的bool数组"""
+    s0, s1 = qbsys.splitStates(idx, False)
+    prob0 = qbsys.squareSum(s0)
+    prob1 = qbsys.squareSum(s1)
+    choice = np.random.random(prob0.shape) * (prob0 + prob1) > prob0
+    if renormalize:
+        factor0 = np.zeros(prob0.shape)
+        factor1 = np.zeros(prob1.shape)
+        np.divide(1., np.sqrt(prob0), out=factor0, where=~choice)
+        np.divide(1., np.sqrt(prob1), out=factor1, where=choice)
+        s0 *= factor0
+        s1 *= factor1
+    else:
+        s0 *= ~choice
+        s1 *= choice
+    return choice.reshape(qbsys.batchShape)
+
+
+def measureQubit(qbsys: QubitsSystem, idx: int) -> Any:
+    """测量系统里的一个量子位, 不经过跟踪和录制
+
+    Args:
+        qbsys: 量子位系统
+        idx: 量子位的索引
+
+    Returns:
+        如果测量为0返回False, 否则返回True. 有成员的轴时返回每个成员的结果
+        组成的数组"""
+    qbsys.flushGates(idx)
+    if qbsys.batchSize is not None:
+        qbsys.normError = 0.
+        return measureMembers(qbsys, idx, True)
+    states = qbsys.statesNd.swapaxes(0, qbsys.statesNdIndex(idx))
+    prob0 = qbsys.squareSum(states[0, ...])
+    prob1 = qbsys.squareSum(states[1, ...])
+    choice = 0 if np.random.random() * (prob0 + prob1) <= prob0 else 1
+    norm = np.sqrt(prob1 if choice else prob0)
+    qbsys.mapChunks(lambda kept, dropped: (np.divide(kept, norm, out=kept),
+                                           dropped.fill(0.)),
+                    states[choice, ...], states[1 - choice, ...])
+    qbsys.normError = 0.
+    return choice == 1
+
+
+def measureQubits(qbsys: QubitsSystem, idxs: List[int]) -> List[Any]:
+    """测量系统里的多个量子位, 不经过跟踪和录制
+
+    先计算这些量子位的联合分布, 只抽取一次结果, 然后一次把状态投影到结果上,
+    而不是逐个量子位测量. 分布和投影都经过`QubitsSystem.mapChunks`, 按系统
+    的chunkSize分块, Options.nThreads大于1时在线程池里处理.
+
+    Args:
+        qbsys: 量子位系统
+        idxs: 量子位的索引
+
+    Returns:
+        bool列表, 如果测量为0返回False, 否则返回True. 有成员的轴时每一项是
+        每个成员的结果组成的数组"""
+    n = len(idxs)
+    if n == 0:
+        return list()
+    squares = marginalProbabilities(qbsys, idxs, False)
+    probs = squares / squares.sum(axis=-1, keepdims=True)
+    cdf = np.cumsum(probs, axis=-1)
+    cdf[..., -1] = 1.
+    axes = [qbsys.statesNdIndex(index) for index in idxs]
+    nBatch = len(qbsys.batchShape)
+    if nBatch:
+        outcomes = np.array([np.searchsorted(c, np.random.random(),
+                                             side="right") for c in cdf])
+        key: Any = (np.arange(len(outcomes)), outcomes)
+    else:
+        outcomes = np.searchsorted(cdf, np.random.random(), side="right")
+        key = int(outcomes)
+    # 结果的部分乘上1/√p完成归一化, 其他部分乘0, 寄存器的轴放到statesNd里
+    # 相应的位置, 按寄存器的轴不分开的块原地相乘
+    factors = np.zeros(probs.shape)
+    factors[key] = 1. / np.sqrt(squares[key])
+    factors = np.moveaxis(
+        factors.astype(qbsys.dtype).reshape(
+            [*qbsys.batchShape, *([2] * n), *([1] * (qbsys.nQubits - n))]),
+        range(nBatch, nBatch + n), axes)
+    qbsys.mapChunks(lambda chunk: np.multiply(chunk, factors, out=chunk),
+                    qbsys.statesNd, keepAxes=tuple(axes))
+    qbsys.normError = 0.
+    if nBatch:
+        return [(outcomes >> (n - 1 - k)) & 1 == 1 for k in range(n)]
+    return [(int(outcomes) >> (n - 1 - k)) & 1 == 1 for k in range(n)]
+
+
+def marginalProbabilities(qbsys: QubitsSystem, idxs: List[int],
+                          normalize: bool = True) -> np.ndarray:
+    """计算idxs组成的整数的概率分布, 不改变系统状态
+
+    idxs里第一个量子位为整数的最高位(不受`Options.littleEndian`影响). 按系统
+    的chunkSize分块累加, 只需要一块大小的临时数组.
+
+    Args:
+        qbsys: 量子位系统
+        idxs: 量子位的索引
+        normalize: 为False时返回每个整数对应部分的模的平方和, 不除以总和
+
+    Returns:
+        长度为2^len(idxs)的概率数组, 有成员的轴时形状为 (batchSize, 2^n)"""
+    qbsys.flushGates(*idxs)
+    axes = [qbsys.statesNdIndex(index) for index in idxs]
+    batchShape = qbsys.batchShape
+    nBatch = len(batchShape)
+    size = 1 << len(axes)
+
+    def partial(chunk: np.ndarray) -> np.ndarray:
+        square = np.moveaxis(np.square(np.abs(chunk)), axes,
+                             range(nBatch, nBatch + len(axes)))
+        return square.reshape([*batchShape, size, -1]).sum(axis=-1)
+
+    probs = np.zeros([*batchShape, size])
+    for part in qbsys.mapChunks(partial, qbsys.statesNd,
+                                keepAxes=tuple(axes)):
+        probs += part
+    if normalize:
+        probs /= probs.sum(axis=-1, keepdims=True)
+    return probs
 
 
 class _MEASURE(QubitsOperation):
@@ -19,7 +154,7 @@ class _MEASURE(QubitsOperation):
         qb: 需要重置的量子位
 
     Returns:
-        如果测量为0返回False, 否则返回True
+        如果测量为0返回False, 否则返回True, 有成员的轴时为数组
     """
 
     def __init__(self) -> None:
@@ -29,13 +164,9 @@ class _MEASURE(QubitsOperation):
 
     def call(self, qb: Qubit) -> bool:
         qbsys = qb.system
-        states = qbsys.statesNd.swapaxes(0, qbsys.statesNdIndex(qb.index))
-        prob0 = sss(states[0, ...])
-        prob1 = sss(states[1, ...])
-        choice = 0 if np.random.random() * (prob0 + prob1) <= prob0 else 1
-        states[choice, ...] /= np.sqrt(sss(states[choice, ...]))
-        states[1 - choice, ...] *= 0.
-        return choice == 1
+        if qbsys.recorder is not None:
+            qbsys.recorder.addOperation(self.name, (), (qb.index,))
+        return measureQubit(qbsys, qb.index)
 
     def __call__(self, qb: Qubit) -> bool:
         qbsys = qb.system
@@ -56,7 +187,7 @@ class _MEASUREALL(QubitsOperation):
         qbs: 需要重置的量子位
 
     Returns:
-        bool列表, 如果测量为0返回False, 否则返回True
+        bool列表, 如果测量为0返回False, 否则返回True, 有成员的轴时每项为数组
     """
 
     def __init__(self) -> None:
@@ -66,16 +197,9 @@ class _MEASUREALL(QubitsOperation):
 
     def call(self, qbs: Qubits) -> List[bool]:
         qbsys = qbs.system
-        result: List[bool] = list()
-        for index in qbs.indexes:
-            states = qbsys.statesNd.swapaxes(0, qbsys.statesNdIndex(index))
-            prob0 = sss(states[0, ...])
-            prob1 = sss(states[1, ...])
-            choice = 0 if np.random.random() * (prob0 + prob1) <= prob0 else 1
-            states[1 - choice, ...] *= 0.
-            result.append(choice == 1)
-        qbsys.normalize()
-        return result
+        if qbsys.recorder is not None:
+            qbsys.recorder.addOperation(self.name, (), tuple(qbs.indexes))
+        return measureQubits(qbsys, qbs.indexes)
 
     def __call__(self, qbs: Qubits) -> List[bool]:
         qbsys = qbs.system
@@ -89,5 +213,62 @@ class _MEASUREALL(QubitsOperation):
         return result
 
 
+class _SAMPLE(QubitsOperation):
+    """多次测量多个量子位的统计结果, 不改变系统状态
+
+    只计算一次这些量子位的概率分布, 然后一次性抽取全部样本, 相当于把系统准备
+    shots次并每次用`MA`测量. 结果的整数与`Bools2Int(MA(qbs))`的位序相同.
+
+    To use:
+    >>> qbsys = QubitsSystem(2)
+    >>> H(qbsys[0])
+    >>> CNOT(qbsys[0], qbsys[1])
+    >>> Sample(qbsys.getQubits(), 1000, counts=True)
+    array([493,   0,   0, 507])
+
+    Args:
+        qbs: 需要测量的量子位
+        shots: 测量的次数
+        counts: 为True时返回每个结果出现的次数, 而不是每次测量的结果
+
+    Returns:
+        每次测量结果的整数组成的数组, 形状为(shots,). counts为True时为长度
+        2^len(qbs)的计数数组. 有成员的轴时在最前增加成员的轴
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.name = "SAMPLE"
+
+    def call(self, qbs: Qubits, shots: int, counts: bool = False) \
+            -> np.ndarray:
+        qbsys = qbs.system
+        idxs = qbs.indexes[::-1] if Options.littleEndian else qbs.indexes
+        probs = marginalProbabilities(qbsys, idxs)
+        cdf = np.cumsum(probs, axis=-1)
+        cdf[..., -1] = 1.
+        samples = np.random.random([*qbsys.batchShape, shots])
+        # 每个成员分别搜索, 没有成员的轴时只有一次
+        flatCdf = cdf.reshape([-1, cdf.shape[-1]])
+        flatSamples = samples.reshape([flatCdf.shape[0], shots])
+        result = np.empty(flatSamples.shape, np.int64)
+        for row, (c, u) in enumerate(zip(flatCdf, flatSamples)):
+            result[row] = np.searchsorted(c, u, side="right")
+        if counts:
+            result = np.stack([np.bincount(row, minlength=cdf.shape[-1])
+                               for row in result])
+        return result.reshape([*qbsys.batchShape, result.shape[-1]])
+
+    def __call__(self, qbs: Qubits, shots: int, counts: bool = False) \
+            -> np.ndarray:
+        if Options.inputCheck:
+            if shots < 0:
+                raise ValueError(f"Cannot sample {shots} shots.")
+            if qbs.haveSameQubit():
+                raise ValueError("Cannot sample the same qubit twice.")
+        return self.call(qbs, shots, counts)
+
+
 M = _MEASURE()
 MA = _MEASUREALL()
+Sample = _SAMPLE()
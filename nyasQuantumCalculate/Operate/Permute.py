@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+from typing import List, Sequence
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from .QFT import alignRegister, mergeRegister
+from nyasQuantumCalculate.System import *
+
+
+__all__: List[str] = list()
+
+
+def rollRegister(qbsys: QubitsSystem, idxs: List[int], shift: int) -> None:
+    """把idxs组成的整数原地加上shift, 即 |B❭ -> |mod(B+shift,N)❭; N = 2^n
+
+    加上常数只是基态的循环置换: 寄存器合并为一个长度为2^n的轴(见
+    `alignRegister`)后, 沿这个轴循环移动shift个位置. 受控时只移动控制位符合
+    的部分, 按系统的chunkSize和Options.nThreads分块处理.
+
+    Args:
+        qbsys: 量子位系统
+        idxs: 寄存器的量子位索引, 第一个为最高位
+        shift: 加数, 会对2^n取模"""
+    n = len(idxs)
+    shift %= 1 << n
+    if qbsys.recorder is not None:
+        qbsys.recorder.addOperation("ROLL", qbsys.controllingQubits,
+                                    tuple(idxs), shift, qbsys.controlValues)
+    if shift == 0:
+        return
+    qbsys.flushGates(*idxs)
+    axes = alignRegister(qbsys, idxs)
+    states = qbsys.statesNd.__getitem__(qbsys.controlIndex())
+
+    def roll(chunk: np.ndarray) -> None:
+        shape, strides = mergeRegister(chunk.shape, chunk.strides, axes)
+        data = as_strided(chunk, shape, strides)
+        tmp = qbsys.getBuffer(shape)
+        np.copyto(tmp, data)
+        data[..., shift:] = tmp[..., :-shift]
+        data[..., :shift] = tmp[..., -shift:]
+
+    qbsys.mapChunks(roll, states, keepAxes=tuple(axes))
+
+
+def splitRegister(chunk: np.ndarray, axes: List[int],
+                  shape: Sequence[int]) -> np.ndarray:
+    """把chunk里寄存器的轴合并后再按shape拆开, 得到chunk的视图
+
+    寄存器必须可以合并(见`alignRegister`), 拆开后的轴依次对应寄存器从高位到
+    低位的各段, 比如shape为(2^m, 2^n)时是A和B两个整数.
+
+    Args:
+        chunk: statesNd的一块
+        axes: 寄存器的轴, 第一个为最高位
+        shape: 各段的长度, 乘积为2^len(axes)
+
+    Returns:
+        形状为 (其他轴, *shape) 的视图"""
+    merged, strides = mergeRegister(chunk.shape, chunk.strides, axes)
+    stride = strides[-1]
+    inner: List[int] = list()
+    for length in reversed(shape):
+        inner.insert(0, stride)
+        stride *= length
+    return as_strided(chunk, (*merged[:-1], *shape),
+                      (*strides[:-1], *inner))
+
+
+def addRegister(qbsys: QubitsSystem, aIdxs: List[int], bIdxs: List[int],
+                inverse: bool) -> None:
+    """把A加到B上, 即 |A❭|B❭ -> |A❭|mod(B+A,N)❭; N = 2^n
+
+    对A的每个值a, B只是循环移动a个位置, 与`rollRegister`相同. A和B合并为
+    (2^m, 2^n)两个轴后按a逐行移动, 不需要临时量子位, 也不需要索引数组.
+
+    Args:
+        qbsys: 量子位系统
+        aIdxs: A的量子位索引, 第一个为最高位
+        bIdxs: B的量子位索引, 第一个为最高位
+        inverse: 为True时从B减去A"""
+    m = len(aIdxs)
+    if qbsys.recorder is not None:
+        qbsys.recorder.addOperation("ADD", qbsys.controllingQubits,
+                                    (*aIdxs, *bIdxs), -m if inverse else m,
+                                    qbsys.controlValues)
+    idxs = [*aIdxs, *bIdxs]
+    qbsys.flushGates(*idxs)
+    axes = alignRegister(qbsys, idxs)
+    states = qbsys.statesNd.__getitem__(qbsys.controlIndex())
+    N = 1 << len(bIdxs)
+
+    def add(chunk: np.ndarray) -> None:
+        data = splitRegister(chunk, axes, (1 << m, N))
+        tmp = qbsys.getBuffer(data.shape)
+        np.copyto(tmp, data)
+        for a in range(1 << m):
+            shift = (-a if inverse else a) % N
+            data[..., a, shift:] = tmp[..., a, :N - shift]
+            data[..., a, :shift] = tmp[..., a, N - shift:]
+
+    qbsys.mapChunks(add, states, keepAxes=tuple(axes))
+
+
+def adderRegister(qbsys: QubitsSystem, cin: int, aIdxs: List[int],
+                  bIdxs: List[int], cout: int) -> None:
+    """|Cin❭|A❭|B❭|Cout❭ -> |Cin❭|A❭|mod(A+B+Cin,N)❭|Cout⊕floor((A+B+Cin)/N)❭
+
+    对Cin和A的每个值, B循环移动s=a+cin个位置, 并且移动后小于s的部分
+    (即发生进位的部分)翻转Cout, 见`addRegister`.
+
+    Args:
+        qbsys: 量子位系统
+        cin: 进位输入的索引
+        aIdxs: A的量子位索引, 第一个为最高位
+        bIdxs: B的量子位索引, 第一个为最高位, 长度与A相同
+        cout: 进位输出的索引"""
+    idxs = [cin, *aIdxs, *bIdxs, cout]
+    if qbsys.recorder is not None:
+        qbsys.recorder.addOperation("ADDER", qbsys.controllingQubits,
+                                    tuple(idxs), 0, qbsys.controlValues)
+    qbsys.flushGates(*idxs)
+    axes = alignRegister(qbsys, idxs)
+    states = qbsys.statesNd.__getitem__(qbsys.controlIndex())
+    N = 1 << len(bIdxs)
+
+    def add(chunk: np.ndarray) -> None:
+        data = splitRegister(chunk, axes, (2, N, N, 2))
+        tmp = qbsys.getBuffer(data.shape)
+        np.copyto(tmp, data)
+        for c in range(2):
+            for a in range(N):
+                shift = a + c
+                data[..., c, a, shift:, :] = tmp[..., c, a, :N - shift, :]
+                data[..., c, a, :shift, :] = tmp[..., c, a, N - shift:, ::-1]
+
+    qbsys.mapChunks(add, states, keepAxes=tuple(axes))
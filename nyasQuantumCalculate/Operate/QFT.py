@@ -1,18 +1,78 @@
 # -*- coding: utf-8 -*-
 
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 from .QubitsOperation import *
 from .Swap import *
 from .SingleQubitGate import *
+from .SingleQubitGate import applyPhases
 from .ControlMethod import *
 from nyasQuantumCalculate.Options import *
+from nyasQuantumCalculate.Utils import *
 from nyasQuantumCalculate.System import *
 
 
 __all__ = ["QFT", "IQFT", "AQFT", "IAQFT"]
 
 
+have_scipy: bool = True
+try:
+    from scipy import fft as scipyFFT
+except ModuleNotFoundError:
+    have_scipy = False
+
+# numpy 2.0开始fft可以输出到给定的数组里
+_fftOut = np.lib.NumpyVersion(np.__version__) >= "2.0.0"
+
+_Layout = Optional[Tuple[Tuple[int, ...], Tuple[int, ...]]]
+# 按(形状, 步长, 寄存器的轴)缓存的合并后的视图, 见`mergeRegister`
+_layouts: Dict[Tuple[Tuple[int, ...], Tuple[int, ...], Tuple[int, ...]],
+               _Layout] = dict()
+
+
+# 按(控制位数量, 是否为逆变换)缓存的受控旋转层的相位数组, 见`rotationLayer`
+_layerTables: Dict[Tuple[int, bool], np.ndarray] = dict()
+
+
+def rotationLayer(qbs: Qubits, target: Qubit, inverse: bool) -> None:
+    """以qbs里的每个量子位为控制位在target上作用受控旋转门
+
+    qbs的第k个量子位控制R_{k+2}(或iR_{k+2}). 这些门都是对角的并且可以交换,
+    合并为qbs上的一个相位数组, 只在target为|1❭的部分作用一次, 见
+    `applyPhases`. 跟踪器里仍然记录每一个受控旋转门.
+
+    Args:
+        qbs: 控制位, 第一个为最高位
+        target: 目标位
+        inverse: 为True时使用逆旋转门"""
+    w = len(qbs)
+    if w == 0:
+        return
+    qbsys = target.system
+    if qbsys.canTrack():
+        gates = RotationGates.iRs if inverse else RotationGates.Rs
+        for k, ctl in enumerate(qbs.indexes):
+            qbsys.addControllingQubits(ctl)
+            qbsys.addTrack(gates[k + 1].name, target.index)
+            qbsys.popControllingQubits()
+    if Options.localityWindow:
+        qbsys.planLayout()
+    table = _layerTables.get((w, inverse))
+    if table is None:
+        sign = -1. if inverse else 1.
+        table = np.exp(sign * 1j * pi * np.arange(1 << w) / (1 << w))
+        _layerTables[(w, inverse)] = table
+    sysStopTrack = qbsys.stopTracking
+    qbsys.stopTracking = True
+    qbsys.addControllingQubits(target.index)
+    applyPhases(qbsys, qbs.indexes, table)
+    qbsys.popControllingQubits()
+    qbsys.stopTracking = sysStopTrack
+
+
 def QFT_gate(qbs: Qubits) -> None:
     n = len(qbs)
     if n == 0:
@@ -23,8 +83,7 @@ def QFT_gate(qbs: Qubits) -> None:
     RotationGates.updateRs(n)
     for idx0, qb in enumerate(qbs):
         H(qb)
-        for idx1, ctlQb in enumerate(qbs[idx0 + 1:]):
-            Controlled(RotationGates.Rs[idx1 + 1], ctlQb.asQubits(), qb)
+        rotationLayer(qbs[idx0 + 1:], qb, False)
     if Options.QFTswap:
         for idx in range(n // 2):
             SWAP(qbs[idx], qbs[-(idx + 1)])
@@ -42,30 +101,170 @@ def iQFT_gate(qbs: Qubits) -> None:
         for idx in range(n // 2):
             SWAP(qbs[idx], qbs[-(idx + 1)])
     for idx0, qb in enumerate(qbs[::-1]):
-        for idx1, ctlQb in enumerate(qbs[n - idx0:]):
-            Controlled(RotationGates.iRs[idx1 + 1], ctlQb.asQubits(), qb)
+        rotationLayer(qbs[n - idx0:], qb, True)
         H(qb)
 
 
+def mergeRegister(shape: Tuple[int, ...], strides: Tuple[int, ...],
+                  axes: Sequence[int]) -> _Layout:
+    """把寄存器的轴合并为最后一个轴, 得到新视图的形状和步长
+
+    寄存器的轴的步长从第一个轴开始依次减半时, 它们在内存里就是一个长度为
+    2^n的轴, 傅里叶变换可以直接在原数组上进行. 结果按形状和步长缓存.
+
+    Args:
+        shape: 数组的形状
+        strides: 数组的步长
+        axes: 寄存器的轴, 第一个为最高位
+
+    Returns:
+        合并后的 (形状, 步长), 不能合并时返回None"""
+    key = (shape, strides, tuple(axes))
+    if key in _layouts:
+        return _layouts[key]
+    layout: _Layout = None
+    if all(strides[axes[k]] == 2 * strides[axes[k + 1]]
+           for k in range(len(axes) - 1)):
+        others = [axis for axis in range(len(shape)) if axis not in axes]
+        layout = ((*(shape[axis] for axis in others), 1 << len(axes)),
+                  (*(strides[axis] for axis in others), strides[axes[-1]]))
+    if len(_layouts) > 1024:
+        _layouts.clear()
+    _layouts[key] = layout
+    return layout
+
+
+def alignRegister(qbsys: QubitsSystem, idxs: Sequence[int]) -> List[int]:
+    """让寄存器在statesNd里可以合并为一个轴, 见`mergeRegister`
+
+    不能合并时整理系统, 寄存器移到它最高的量子位所在的位置, 其他量子位的
+    顺序不变. 之后在同一寄存器上的操作都不需要再复制系统.
+
+    Args:
+        qbsys: 量子位系统
+        idxs: 寄存器的量子位索引, 第一个为最高位
+
+    Returns:
+        寄存器在statesNd里的轴"""
+    axes = [qbsys.statesNdIndex(index) for index in idxs]
+    statesNd = qbsys.statesNd
+    if mergeRegister(statesNd.shape, statesNd.strides, axes) is None:
+        order = qbsys.axisOrder()
+        pos = min(order.index(index) for index in idxs)
+        order = [index for index in order if index not in idxs]
+        order[pos:pos] = idxs
+        qbsys.compactStates(order)
+        axes = [qbsys.statesNdIndex(index) for index in idxs]
+    return axes
+
+
+def fftRegister(qbsys: QubitsSystem, idxs: List[int], inverse: bool) -> None:
+    """在idxs组成的整数上原地作用(逆)离散傅里叶变换, 不处理QFTswap
+
+    寄存器在statesNd里不是连续的轴时, 先整理系统让它们成为连续的轴(见
+    `alignRegister`), 之后在同一寄存器上的变换都不需要复制系统. 安装了scipy
+    时使用scipy.fft并以Options.nThreads个线程计算, 否则使用numpy.fft, 按系统
+    的chunkSize和Options.nThreads分块处理, 每一块包含整个寄存器.
+
+    Args:
+        qbsys: 量子位系统
+        idxs: 寄存器的量子位索引, 第一个为最高位
+        inverse: 为True时作用逆变换"""
+    if qbsys.recorder is not None:
+        qbsys.recorder.addOperation("FFT", qbsys.controllingQubits,
+                                    tuple(idxs), int(inverse),
+                                    qbsys.controlValues)
+    qbsys.flushGates(*idxs)
+    qbsys.toComplex()
+    axes = alignRegister(qbsys, idxs)
+    # 控制位使用长度为1的切片, 所以寄存器的轴和步长不变
+    states = qbsys.statesNd.__getitem__(qbsys.controlIndex())
+
+    def transform(chunk: np.ndarray) -> None:
+        shape, strides = mergeRegister(chunk.shape, chunk.strides, axes)
+        data = as_strided(chunk, shape, strides)
+        if have_scipy:
+            func = scipyFFT.fft if inverse else scipyFFT.ifft
+            result = func(data, axis=-1, norm="ortho", overwrite_x=True,
+                          workers=Options.nThreads)
+            if result is not data:
+                np.copyto(data, result)
+            return
+        func = np.fft.fft if inverse else np.fft.ifft
+        if _fftOut:
+            func(data, axis=-1, norm="ortho", out=data)
+        else:
+            data.__setitem__(..., func(data, axis=-1, norm="ortho"))
+
+    if have_scipy:
+        # scipy.fft自己使用多个线程
+        for chunk, in qbsys.iterChunks(states, keepAxes=tuple(axes)):
+            transform(chunk)
+    else:
+        qbsys.mapChunks(transform, states, keepAxes=tuple(axes))
+
+
+def aqftRegister(qbsys: QubitsSystem, idxs: List[int], m: int,
+                 inverse: bool) -> None:
+    """在idxs组成的寄存器上作用(逆)近似量子傅里叶变换, 不处理QFTswap
+
+    与`AQFT`的位门实现作用相同的变换, 但每个量子位只需要一次蝶形运算和一次
+    对角的相位乘法: 它与后面m-1个量子位之间的受控旋转门都是对角的, 合并为
+    一个只有2^(m-1)个元素的相位数组, 与这个量子位为|1❭的一半状态相乘.
+    Hadamard门的系数1/√2在最后一次乘到寄存器上.
+
+    Args:
+        qbsys: 量子位系统
+        idxs: 寄存器的量子位索引, 第一个为最高位
+        m: 近似的参数, 见`AQFT`
+        inverse: 为True时使用逆旋转门, 与`IAQFT`的位门实现相同"""
+    if qbsys.recorder is not None:
+        qbsys.recorder.addOperation("AQFT", qbsys.controllingQubits,
+                                    tuple(idxs), -m if inverse else m,
+                                    qbsys.controlValues)
+    qbsys.flushGates(*idxs)
+    qbsys.toComplex()
+    n = len(idxs)
+    sign = -1. if inverse else 1.
+    states = qbsys.statesNd.__getitem__(qbsys.controlIndex())
+
+    def butterfly(s0: np.ndarray, s1: np.ndarray) -> None:
+        tmp = qbsys.getBuffer(s0.shape)
+        np.copyto(tmp, s0)
+        s0 += s1
+        np.subtract(tmp, s1, out=s1)
+
+    for j in range(n):
+        # 使用长度为1的切片, 所以相位数组可以直接按轴广播
+        index: List[Any] = [slice(None)] * states.ndim
+        index[qbsys.statesNdIndex(idxs[j])] = slice(0, 1)
+        s0 = states.__getitem__(tuple(index))
+        index[qbsys.statesNdIndex(idxs[j])] = slice(1, 2)
+        s1 = states.__getitem__(tuple(index))
+        qbsys.mapChunks(butterfly, s0, s1)
+        window = idxs[j + 1:min(j + m, n)]
+        if not window:
+            continue
+        axes = [qbsys.statesNdIndex(index) for index in window]
+        phases = np.ones([1] * s1.ndim, qbsys.dtype)
+        for k, axis in enumerate(axes):
+            shape = [1] * s1.ndim
+            shape[axis] = 2
+            phases = phases * np.array(
+                [1., np.exp(sign * 1j * pi / (2 << k))],
+                qbsys.dtype).reshape(shape)
+        qbsys.mapChunks(lambda chunk: np.multiply(chunk, phases, out=chunk),
+                        s1, keepAxes=tuple(axes))
+    scale = np.sqrt(.5) ** n
+    qbsys.mapChunks(lambda chunk: np.multiply(chunk, scale, out=chunk),
+                    states)
+    qbsys.afterUnitary(n * H.normError)
+
+
 def QFT_numpy(qbs: Qubits) -> None:
     if len(qbs) == 0:
         return
-    qbsys = qbs.system
-    qbs_indexes = [qbsys.statesNdIndex(index) for index in qbs.indexes]
-    indexesR = qbs_indexes + [index for index in range(qbsys.nQubits)
-                              if index not in qbs_indexes]
-    indexes = list(range(qbsys.nQubits))
-    for index0, index1 in enumerate(indexesR):
-        indexes[index1] = index0
-    controlling = (..., *([1] * qbsys.nControllingQubits))
-    states = qbsys.statesNd. \
-        transpose(indexesR). \
-        reshape([-1] + [2] * (qbsys.nQubits - len(qbs))).copy()
-    after: np.ndarray = 2 ** (len(qbs) / 2) * \
-        np.fft.ifft(states.__getitem__(controlling), axis=0)
-    states.__setitem__(controlling, after)
-    qbsys.statesNd *= 0.
-    qbsys.statesNd += states.reshape([2] * qbsys.nQubits).transpose(indexes)
+    fftRegister(qbs.system, qbs.indexes, False)
     if not Options.QFTswap:
         for idx in range(len(qbs) // 2):
             SWAP(qbs[idx], qbs[-(idx + 1)])
@@ -77,22 +276,7 @@ def iQFT_numpy(qbs: Qubits) -> None:
     if not Options.QFTswap:
         for idx in range(len(qbs) // 2):
             SWAP(qbs[idx], qbs[-(idx + 1)])
-    qbsys = qbs.system
-    qbs_indexes = [qbsys.statesNdIndex(index) for index in qbs.indexes]
-    indexesR = qbs_indexes + [index for index in range(qbsys.nQubits)
-                              if index not in qbs_indexes]
-    indexes = list(range(qbsys.nQubits))
-    for index0, index1 in enumerate(indexesR):
-        indexes[index1] = index0
-    controlling = (..., *([1] * qbsys.nControllingQubits))
-    states = qbsys.statesNd. \
-        transpose(indexesR). \
-        reshape([-1] + [2] * (qbsys.nQubits - len(qbs))).copy()
-    after: np.ndarray = 2 ** (-len(qbs) / 2) * \
-        np.fft.fft(states.__getitem__(controlling), axis=0)
-    states.__setitem__(controlling, after)
-    qbsys.statesNd *= 0.
-    qbsys.statesNd += states.reshape([2] * qbsys.nQubits).transpose(indexes)
+    fftRegister(qbs.system, qbs.indexes, True)
 
 
 class _QFT(QubitsOperation):
@@ -177,8 +361,9 @@ class _AQFT(QubitsOperation):
     是控制AQFT精度的参数, m只能大于0小于等于输入qbs的长度. 当
     m=1时, 即是Hadamard变换, m=输入qbs长度即为QFT.
 
-    注意: AQFT是由位门实现的, 而在这里QFT提供numpy实现, 在很多量子位
-    的情况下numpy实现的QFT比位门实现的AQFT要快很多倍.
+    Options.QFTwithNumpy开启时, 每个量子位的受控旋转门合并为一次对角的
+    相位乘法(见`aqftRegister`), 否则由位门实现. 在很多量子位的情况下numpy
+    实现的QFT仍然比AQFT快, 但m较小的AQFT需要的运算更少.
     """
 
     def __init__(self) -> None:
@@ -194,6 +379,12 @@ class _AQFT(QubitsOperation):
         if n == 1:
             H(qbs[0])
             return
+        if Options.QFTwithNumpy:
+            aqftRegister(qbs.system, qbs.indexes, m, False)
+            if Options.QFTswap:
+                for idx in range(n // 2):
+                    SWAP(qbs[idx], qbs[-(idx + 1)])
+            return
         RotationGates.updateRs(n)
         for idx0, qb in enumerate(qbs):
             H(qb)
@@ -235,6 +426,12 @@ class _iAQFT(QubitsOperation):
         if n == 1:
             H(qbs[0])
             return
+        if Options.QFTwithNumpy:
+            aqftRegister(qbs.system, qbs.indexes, m, True)
+            if Options.QFTswap:
+                for idx in range(n // 2):
+                    SWAP(qbs[idx], qbs[-(idx + 1)])
+            return
         RotationGates.updateiRs(n)
         for idx0, qb in enumerate(qbs):
             H(qb)
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from typing import List
+
 import numpy as np
 
 from .QubitsOperation import *
@@ -10,6 +12,41 @@ from nyasQuantumCalculate.System import *
 __all__ = ["R", "RA"]
 
 
+def resetQubit(qbsys: QubitsSystem, idx: int) -> None:
+    """重置系统里的一个量子位, 不经过跟踪和录制
+
+    Args:
+        qbsys: 量子位系统
+        idx: 量子位的索引"""
+    qbsys.flushGates(idx)
+    s0, s1 = qbsys.splitStates(idx, False)
+    prob0 = qbsys.squareSum(s0)
+    if np.any(qbsys.equal0(prob0)):
+        # 有成员的轴时, 只复制|0❭部分为0的成员
+        np.copyto(s0, s1, where=qbsys.equal0(prob0))
+        prob0 = qbsys.squareSum(s0)
+    norm = np.sqrt(prob0)
+    qbsys.mapChunks(lambda c0, c1: (np.divide(c0, norm, out=c0), c1.fill(0.)),
+                    s0, s1)
+    qbsys.normError = 0.
+
+
+def resetQubits(qbsys: QubitsSystem, idxs: List[int]) -> None:
+    """重置系统里的多个量子位, 不经过跟踪和录制
+
+    Args:
+        qbsys: 量子位系统
+        idxs: 量子位的索引"""
+    qbsys.flushGates(*idxs)
+    for index in idxs:
+        s0, s1 = qbsys.splitStates(index, False)
+        prob0 = qbsys.squareSum(s0)
+        if np.any(qbsys.equal0(prob0)):
+            np.copyto(s0, s1, where=qbsys.equal0(prob0))
+        s1 *= 0.
+    qbsys.normalize()
+
+
 class _RESET(QubitsOperation):
     """重置一个量子位
 
@@ -26,12 +63,9 @@ class _RESET(QubitsOperation):
 
     def call(self, qb: Qubit) -> None:
         qbsys = qb.system
-        states = qbsys.statesNd.swapaxes(0, qbsys.statesNdIndex(qb.index))
-        prob0 = sss(states[0, ...])
-        if equal0(prob0):
-            states[0, ...] = states[1, ...]
-        states[0, ...] /= np.sqrt(sss(states[0, ...]))
-        states[1, ...] *= 0.
+        if qbsys.recorder is not None:
+            qbsys.recorder.addOperation(self.name, (), (qb.index,))
+        resetQubit(qbsys, qb.index)
 
     def __call__(self, qb: Qubit) -> None:
         qbsys = qb.system
@@ -61,13 +95,9 @@ class _RESETALL(QubitsOperation):
 
     def call(self, qbs: Qubits) -> None:
         qbsys = qbs.system
-        for index in qbs.indexes:
-            states = qbsys.statesNd.swapaxes(0, qbsys.statesNdIndex(index))
-            prob0 = sss(states[0, ...])
-            if equal0(prob0):
-                states[0, ...] = states[1, ...]
-            states[1, ...] *= 0.
-        qbsys.normalize()
+        if qbsys.recorder is not None:
+            qbsys.recorder.addOperation(self.name, (), tuple(qbs.indexes))
+        resetQubits(qbsys, qbs.indexes)
 
     def __call__(self, qbs: Qubits) -> None:
         qbsys = qbs.system
@@ -10,6 +10,17 @@ from nyasQuantumCalculate.System import *
 __all__ = ["SWAP"]
 
 
+def swapQubits(qbsys: QubitsSystem, idx0: int, idx1: int) -> None:
+    """交换系统里两个量子位的数据(无视控制位), 不经过跟踪和录制
+
+    Args:
+        qbsys: 量子位系统
+        idx0: 量子位的索引
+        idx1: 量子位的索引"""
+    qbsys.flushGates(idx0, idx1)
+    qbsys.swapStates(idx0, idx1)
+
+
 class _SWAP(QubitsOperation):
     """交换量子位数据
 
@@ -40,10 +51,10 @@ class _SWAP(QubitsOperation):
     def call(self, q0: Qubit, q1: Qubit) -> None:
         qbsys = q0.system
         if qbsys.nControllingQubits == 0:
-            qbsys.statesNd = qbsys.statesNd.swapaxes(
-                qbsys.statesNdIndex(q0.index),
-                qbsys.statesNdIndex(q1.index)
-            )
+            if qbsys.recorder is not None:
+                qbsys.recorder.addOperation(self.name, (),
+                                            (q0.index, q1.index))
+            swapQubits(qbsys, q0.index, q1.index)
         else:
             # 事实上, 受控SWAP应该为
             # CNOT(q1, q0); Controlled(CNOT, ctlQbs, q0, q1); CNOT(q1, q0)
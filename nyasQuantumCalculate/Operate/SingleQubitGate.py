@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from typing import Any, List
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 
@@ -21,8 +21,21 @@ class SingleQubitGate(QubitsOperation):
     检查4个数字是否组成单量子位门. 输入参数`name`可以定义门的名字以方便跟踪. 并且
     被作用单量子位门的量子位不能是控制位.
 
+    参数为长度batchSize的数组时, 得到每个成员使用各自矩阵的位门, 矩阵形状为
+    (2, 2, batchSize), 只能作用在有成员的轴的系统上(见`QubitsSystem`), 并且
+    不会被合并或录制.
+
     Attributes:
         matrix: 单量子位门里的矩阵
+        kind:
+            矩阵的结构, 每次设置matrix时自动分类, 作用时按结构选择原地运算的
+            方法, 可能为"identity", "diagonal", "antidiagonal", "real" 或
+            "general". 注意直接修改matrix里的元素(如`gate.matrix[0, 1] = 0`)
+            不会重新分类
+        normError: 作用一次位门引起的范数误差上界, 与kind一起更新
+        isReal:
+            矩阵是否只有实数元素, 与kind一起更新. 含有复数的位门作用在实数系统
+            上时, 系统会先转为复数系统
     """
 
     def __init__(self,
@@ -38,13 +51,73 @@ class SingleQubitGate(QubitsOperation):
         self.controllable = True
         self.trackable = True
         self._isBuiltin = kwargs.get("_isBuiltin", False)
-        self.matrix = np.array(((a, b), (c, d)), np.complex128)
+        shape = np.broadcast(a, b, c, d).shape
+        if shape:
+            m = np.empty((2, 2, *shape), np.complex128)
+            m[0, 0], m[0, 1], m[1, 0], m[1, 1] = a, b, c, d
+            self.matrix = m
+        else:
+            self.matrix = np.array(((a, b), (c, d)), np.complex128)
+
+    @property
+    def matrix(self) -> np.ndarray: return self._matrix
+
+    @matrix.setter
+    def matrix(self, m: np.ndarray) -> None:
+        self._matrix = m
+        self._matrices: Dict[np.dtype, np.ndarray] = dict()
+        self.kind = self.classify(m)
+        self.isReal = not np.any(m.imag)
+        if m.ndim == 2:
+            self.normError = float(np.linalg.norm(m.conj().T @ m - np.eye(2)))
+            return
+        ms = np.moveaxis(m.reshape([2, 2, -1]), 2, 0)
+        self.normError = float(np.max(np.linalg.norm(
+            ms.conj().swapaxes(1, 2) @ ms - np.eye(2), axis=(1, 2))))
+
+    def matrixAs(self, dtype: np.dtype) -> np.ndarray:
+        """得到转换为dtype类型的矩阵, 转换结果会被缓存
+
+        Args:
+            dtype: 量子位系统的数据类型
+
+        Returns:
+            与matrix相同的矩阵"""
+        m = self._matrices.get(dtype)
+        if m is None:
+            m = self._matrix.real if np.dtype(dtype).kind == 'f' \
+                else self._matrix
+            m = m.astype(dtype)
+            self._matrices[dtype] = m
+        return m
+
+    @staticmethod
+    def classify(m: np.ndarray) -> str:
+        """按矩阵结构把单量子位门分类
+
+        Args:
+            m: 2x2矩阵, 或每个成员的矩阵(只会分为"real"或"general")
+
+        Returns:
+            "identity", "diagonal", "antidiagonal", "real", "general" 其中之一"""
+        if m.ndim > 2:
+            return "general" if np.any(m.imag) else "real"
+        (a, b), (c, d) = m
+        if b == 0. and c == 0.:
+            if a == 1. and d == 1.:
+                return "identity"
+            return "diagonal"
+        if a == 0. and d == 0.:
+            return "antidiagonal"
+        if not np.any(m.imag):
+            return "real"
+        return "general"
 
     def copy(self) -> "SingleQubitGate":
         new = SingleQubitGate(0., 0., 0., 0., _notCheck=True)
         new.name = self.name
         new.controllable = self.controllable
-        self.trackable = self.trackable
+        new.trackable = self.trackable
         new.matrix = self.matrix.copy()
         return new
 
@@ -64,10 +137,11 @@ class SingleQubitGate(QubitsOperation):
         absB = np.square(np.abs(b))
         absC = np.square(np.abs(c))
         absD = np.square(np.abs(d))
-        return equal0(np.abs(a * np.conj(c) + b * np.conj(d))) and \
-            equal0(np.abs(a * np.conj(b) + c * np.conj(d))) and \
-            equal0(absA + absB - 1.) and equal0(absA + absC - 1.) and \
-            equal0(absD + absB - 1.) and equal0(absD + absC - 1.)
+        return bool(np.all(
+            equal0(np.abs(a * np.conj(c) + b * np.conj(d))) &
+            equal0(np.abs(a * np.conj(b) + c * np.conj(d))) &
+            equal0(absA + absB - 1.) & equal0(absA + absC - 1.) &
+            equal0(absD + absB - 1.) & equal0(absD + absC - 1.)))
 
     def __str__(self) -> str:
         return f"{self.name} Gate"
@@ -76,30 +150,40 @@ class SingleQubitGate(QubitsOperation):
         (a, b), (c, d) = self.matrix
         return f"{self.name}[{a:.2f} {b:.2f}; {c:.2f} {d:.2f}]"
 
+    def apply(self, qbsys: QubitsSystem, idx: int,
+              controlled: bool = True) -> None:
+        """把位门作用到系统的量子位上, 不经过跟踪和等待队列
+
+        Args:
+            qbsys: 量子位系统
+            idx: 量子位的索引
+            controlled: 为False时无视系统里的控制位"""
+        if not self.isReal:
+            qbsys.toComplex()
+        if self.kind != "identity":
+            kernel = _kernels[self.kind]
+            m = self.matrixAs(qbsys.dtype)
+            s0, s1 = qbsys.splitStates(idx, controlled)
+            if m.ndim > 2:
+                if qbsys.batchShape != m.shape[2:]:
+                    raise ValueError("The gate has parameters for "
+                                     f"{m.shape[2:]} members, but the "
+                                     f"system has {qbsys.batchShape}.")
+                # 成员的轴在状态视图的最前面
+                m = m.reshape([*m.shape, *([1] * (s0.ndim - 1))])
+            qbsys.applyKernel(kernel, m, s0, s1)
+        qbsys.afterUnitary(self.normError)
+
     def call(self, qb: Qubit) -> None:
         qbsys = qb.system
-        m = self.matrix
-        controlling0 = (0, ..., *([1] * qbsys.nControllingQubits))
-        controlling1 = (1, ..., *([1] * qbsys.nControllingQubits))
-        states = qbsys.statesNd.swapaxes(0, qbsys.statesNdIndex(qb.index))
-        new0 = states.__getitem__(controlling0).copy()
-        if m[0, 1] == 0.:
-            new0 *= m[0, 0]
-        else:
-            new0 *= m[0, 0] / m[0, 1]
-            new0 += states.__getitem__(controlling1)
-            new0 *= m[0, 1]
-        new1 = states.__getitem__(controlling0).copy()
-        if m[1, 1] == 0.:
-            new1 *= m[1, 0]
-        else:
-            new1 *= m[1, 0] / m[1, 1]
-            new1 += states.__getitem__(controlling1)
-            new1 *= m[1, 1]
-        states.__setitem__(controlling0, new0)
-        states.__setitem__(controlling1, new1)
-        if Options.autoNormalize:
-            qbsys.normalize()
+        if qbsys.recorder is not None:
+            qbsys.recorder.addGate(self, qbsys.controllingQubits, qb.index,
+                                   qbsys.controlValues)
+        if Options.fuseGates and self.matrix.ndim == 2 and \
+                fuseGate(qbsys, self, qb.index):
+            return
+        qbsys.flushGates(qb.index)
+        self.apply(qbsys, qb.index)
 
     def __call__(self, qb: Qubit) -> None:
         qbsys = qb.system
@@ -149,6 +233,296 @@ class SingleQubitGate(QubitsOperation):
         return new.__ipow__(n)
 
 
+###############################################################################
+#############################  Gate kernels  ##################################
+###############################################################################
+# s0和s1分别是目标位为|0❭和|1❭的状态视图, 所有方法都原地修改状态
+
+
+def _applyDiagonal(m: np.ndarray, s0: np.ndarray, s1: np.ndarray,
+                   qbsys: QubitsSystem) -> None:
+    if m[0, 0] != 1.:
+        s0 *= m[0, 0]
+    if m[1, 1] != 1.:
+        s1 *= m[1, 1]
+
+
+def _applyAntidiagonal(m: np.ndarray, s0: np.ndarray, s1: np.ndarray,
+                       qbsys: QubitsSystem) -> None:
+    tmp = qbsys.getBuffer(s0.shape)
+    np.copyto(tmp, s0)
+    np.copyto(s0, s1)
+    if m[0, 1] != 1.:
+        s0 *= m[0, 1]
+    np.copyto(s1, tmp)
+    if m[1, 0] != 1.:
+        s1 *= m[1, 0]
+
+
+def _applyGeneral(m: np.ndarray, s0: np.ndarray, s1: np.ndarray,
+                  qbsys: QubitsSystem) -> None:
+    (a, b), (c, d) = m
+    tmp0 = qbsys.getBuffer(s0.shape, 0)
+    tmp1 = qbsys.getBuffer(s0.shape, 1)
+    np.copyto(tmp0, s0)
+    np.multiply(s1, b, out=tmp1)
+    s0 *= a
+    s0 += tmp1
+    s1 *= d
+    tmp0 *= c
+    s1 += tmp0
+
+
+def _applyReal(m: np.ndarray, s0: np.ndarray, s1: np.ndarray,
+               qbsys: QubitsSystem) -> None:
+    # 实数与复数数组相乘比复数与复数相乘要快
+    _applyGeneral(m.real, s0, s1, qbsys)
+
+
+_kernels = {
+    "diagonal": _applyDiagonal,
+    "antidiagonal": _applyAntidiagonal,
+    "real": _applyReal,
+    "general": _applyGeneral,
+}
+
+
+def applyPhases(qbsys: QubitsSystem, idxs: List[int],
+                phases: np.ndarray) -> None:
+    """把对角矩阵作用到系统的受控部分上
+
+    idxs组成的整数为i(第一个量子位为最高位)的部分乘上phases[i], 整个对角
+    矩阵只需要一次乘法. 用于合并许多可以交换的对角位门, 比如受控旋转门.
+
+    Args:
+        qbsys: 量子位系统
+        idxs: 量子位的索引
+        phases: 长度为2^len(idxs)的相位数组, 每个元素的模应该为1"""
+    if qbsys.recorder is not None:
+        qbsys.recorder.addPhases(phases, qbsys.controllingQubits,
+                                 tuple(idxs), qbsys.controlValues)
+    qbsys.flushGates(*idxs)
+    if np.any(phases.imag):
+        qbsys.toComplex()
+    else:
+        phases = phases.real
+    states = qbsys.statesNd.__getitem__(qbsys.controlIndex())
+    axes = [qbsys.statesNdIndex(idx) for idx in idxs]
+    # 相位数组的轴按statesNd里的顺序排列, 其他轴长度为1, 可以直接广播
+    shape = [1] * states.ndim
+    for axis in axes:
+        shape[axis] = 2
+    table = phases.astype(qbsys.dtype).reshape([2] * len(idxs)) \
+        .transpose(np.argsort(axes)).reshape(shape)
+    qbsys.mapChunks(lambda chunk: np.multiply(chunk, table, out=chunk),
+                    states, keepAxes=tuple(axes))
+    qbsys.afterUnitary(float(np.max(np.abs(np.abs(phases) - 1.))))
+
+
+###############################################################################
+##############################  Gate fusion  ##################################
+###############################################################################
+
+
+def applyMatrix(qbsys: QubitsSystem, idxs: List[int], m: np.ndarray) -> None:
+    """把作用在多个量子位上的矩阵作用到整个系统上(无视控制位)
+
+    矩阵的索引顺序与`Bools2Int`相同, 即idxs里第一个量子位为最高位. 把状态按
+    这些量子位分为2^n片, 对于比较稀疏的矩阵(如受控门, 置换, 对角矩阵), 只原地
+    修改需要改变的片, 否则按系统的chunkSize分块做矩阵乘法.
+
+    Args:
+        qbsys: 量子位系统
+        idxs: 量子位的索引
+        m: 2^n x 2^n 的矩阵, n为idxs的长度"""
+    if np.any(m.imag):
+        qbsys.toComplex()
+    else:
+        m = m.real
+    m = m.astype(qbsys.dtype)
+    n = len(idxs)
+    size = 1 << n
+    axes = [qbsys.statesNdIndex(idx) for idx in idxs]
+    nonzero = m != 0.
+    rows = [i for i in range(size)
+            if np.count_nonzero(nonzero[i]) != 1 or m[i, i] != 1.]
+    if not rows:
+        return
+    # 需要先复制的片: 会被覆盖, 并且被其他片用到
+    saved = [j for j in range(size)
+             if j in rows and any(nonzero[i, j] for i in rows if i != j)]
+    terms = sum(np.count_nonzero(nonzero[i]) for i in rows)
+    if len(saved) + 2 * terms > 4 * size:
+        def multiply(chunk: np.ndarray) -> None:
+            moved = np.moveaxis(chunk, axes, range(n))
+            data = m @ moved.reshape([size, -1])
+            moved.__setitem__(..., data.reshape(moved.shape))
+
+        qbsys.mapChunks(multiply, qbsys.statesNd, keepAxes=tuple(axes))
+        return
+    bits = [tuple((i >> (n - 1 - b)) & 1 for b in range(n))
+            for i in range(size)]
+
+    def combine(chunk: np.ndarray) -> None:
+        moved = np.moveaxis(chunk, axes, range(n))
+        parts = [moved.__getitem__((*bit, ...)) for bit in bits]
+        buffer = qbsys.getBuffer((len(saved), *parts[0].shape), 0)
+        tmp = qbsys.getBuffer(parts[0].shape, 1)
+        sources = parts.copy()
+        for k, j in enumerate(saved):
+            sources[j] = buffer[k, ...]
+            np.copyto(sources[j], parts[j])
+        for i in rows:
+            cols = list(np.flatnonzero(nonzero[i]))
+            if i in cols:
+                # 自身的项先在原地计算
+                cols.remove(i)
+                cols.insert(0, i)
+            for k, j in enumerate(cols):
+                if k == 0:
+                    np.multiply(sources[j], m[i, j], out=parts[i])
+                else:
+                    np.multiply(sources[j], m[i, j], out=tmp)
+                    parts[i] += tmp
+
+    qbsys.mapChunks(combine, qbsys.statesNd, keepAxes=tuple(axes))
+
+
+def controlledMatrix(m: np.ndarray, values: Tuple[bool, ...]) -> np.ndarray:
+    """受控单量子位门的矩阵, 控制位在前(高位), 目标位在最后(最低位)
+
+    Args:
+        m: 单量子位门的矩阵
+        values: 每个控制位需要的值
+
+    Returns:
+        控制位符合values的块为m, 其余为单位矩阵"""
+    pos = 0
+    for value in values:
+        pos = (pos << 1) | int(value)
+    result = np.eye(2 << len(values), dtype=m.dtype)
+    result[2 * pos:2 * pos + 2, 2 * pos:2 * pos + 2] = m
+    return result
+
+
+class FusedGate:
+    """FusedGate(idxs)
+
+    多个(受控)单量子位门相乘得到的位门, 用于`Options.fuseGates`.
+
+    Attributes:
+        indexes: 作用的量子位索引, 第一个为矩阵的最高位
+        matrix: 2^n x 2^n 的矩阵
+        source: 只包含一个位门时为(位门, 控制位, 控制位的值, 目标位), 否则为None
+    """
+
+    def __init__(self, idxs: List[int]) -> None:
+        self.indexes = list(idxs)
+        self.matrix = np.eye(1 << len(idxs), dtype=np.complex128)
+        self.source: Optional[Tuple[SingleQubitGate, Tuple[int, ...],
+                                    Tuple[bool, ...], int]] = None
+
+    def absorb(self, m: np.ndarray, idxs: List[int]) -> None:
+        """在这个位门之后作用矩阵m, 即 matrix = m @ matrix
+
+        Args:
+            m: 2^k x 2^k 的矩阵
+            idxs: m作用的量子位, 必须都在indexes里"""
+        self.source = None
+        n = len(self.indexes)
+        k = len(idxs)
+        if idxs == self.indexes:
+            self.matrix = m @ self.matrix
+            self.clean()
+            return
+        positions = [self.indexes.index(idx) for idx in idxs]
+        result = np.tensordot(m.reshape([2] * (2 * k)),
+                              self.matrix.reshape([2] * n + [-1]),
+                              axes=(range(k, 2 * k), positions))
+        self.matrix = np.moveaxis(result, range(k), positions). \
+            reshape([1 << n, 1 << n])
+        self.clean()
+
+    def clean(self) -> None:
+        """把矩阵里舍入误差级别的元素设为0, 保持矩阵的稀疏性"""
+        self.matrix[np.abs(self.matrix) < 16. * np.finfo(np.float64).eps] = 0.
+
+    def apply(self, qbsys: QubitsSystem) -> None:
+        """把位门作用到系统上(无视控制位)"""
+        if self.source is not None:
+            # 只有一个位门时直接用单量子位门的核, 省去矩阵的开销
+            gate, ctls, values, idx = self.source
+            if not gate.isReal:
+                qbsys.toComplex()
+            if gate.kind != "identity":
+                kernel = _kernels[gate.kind]
+                m = gate.matrixAs(qbsys.dtype)
+                qbsys.applyKernel(kernel, m,
+                                  *qbsys.splitStatesAt(idx, ctls, values))
+            qbsys.afterUnitary(gate.normError)
+            return
+        if len(self.indexes) == 1:
+            (a, b), (c, d) = self.matrix
+            gate = SingleQubitGate(a, b, c, d, _notCheck=True)
+            gate.apply(qbsys, self.indexes[0], False)
+            return
+        applyMatrix(qbsys, self.indexes, self.matrix)
+        n = 1 << len(self.indexes)
+        qbsys.afterUnitary(float(np.linalg.norm(
+            self.matrix.conj().T @ self.matrix - np.eye(n))))
+
+
+def fuseGate(qbsys: QubitsSystem, gate: SingleQubitGate, idx: int) -> bool:
+    """把(受控)单量子位门合并到等待中的位门里
+
+    系统里的控制位也是这个位门的控制位. 新位门会与用到相同量子位的等待中的
+    位门合并, 如果没有的话, 会尝试合并到最大的可以容纳它的位门里. 合并后
+    超过`Options.fuseQubits`个量子位时, 先作用相关的等待中的位门.
+
+    Args:
+        qbsys: 量子位系统
+        gate: 单量子位门
+        idx: 目标量子位的索引
+
+    Returns:
+        为False时位门太大而没有被合并, 需要直接作用"""
+    ctls = qbsys.controllingQubits
+    values = qbsys.controlValues
+    idxs = [*ctls, idx]
+    if len(idxs) > Options.fuseQubits:
+        return False
+    m = gate.matrix
+    if ctls:
+        m = controlledMatrix(m, values)
+    gates = qbsys.getPendingGates(*idxs)
+    union = [i for pending in gates for i in pending.indexes]
+    union += [i for i in idxs if i not in union]
+    if len(union) > Options.fuseQubits:
+        qbsys.flushGates(*idxs)
+        gates = list()
+        union = idxs
+    if not gates:
+        # 没有用到相同量子位的位门时, 与其他量子位上的位门放在同一层
+        for pending in sorted(qbsys.getPendingGates(),
+                              key=lambda g: -len(g.indexes)):
+            if len(pending.indexes) + len(idxs) <= Options.fuseQubits:
+                gates = [pending]
+                union = pending.indexes + idxs
+                break
+    if len(gates) == 1 and len(gates[0].indexes) == len(union):
+        gates[0].absorb(m, idxs)
+        return True
+    qbsys.popPendingGates(*union)
+    fused = FusedGate(union)
+    for pending in gates:
+        fused.absorb(pending.matrix, pending.indexes)
+    fused.absorb(m, idxs)
+    if not gates:
+        fused.source = (gate, ctls, values, idx)
+    qbsys.pendGate(fused)
+    return True
+
+
 ###############################################################################
 ############################  Built-in Gates  #################################
 ###############################################################################
@@ -184,37 +558,44 @@ TR = SingleQubitGate(1., 0., 0., rsqrt2 - 1j*rsqrt2,
                      _notCheck=True, _isBuiltin=True, name='T^-1')
 
 
+def angleName(theta: Any) -> str:
+    """旋转门名字里的角度, theta为数组时(每个成员各自的角度)只显示数量"""
+    if np.ndim(theta):
+        return f"{np.size(theta)} angles"
+    return f"{theta:.4f}"
+
+
 def Rx(theta: float) -> SingleQubitGate:
     a = np.cos(theta / 2.)
     b = -1j * np.sin(theta / 2.)
     return SingleQubitGate(a, b, b, a,
-                           _notCheck=True, name=f"Rx({theta:.4f})")
+                           _notCheck=True, name=f"Rx({angleName(theta)})")
 
 
 def Ry(theta: float) -> SingleQubitGate:
     a = np.cos(theta / 2.)
     b = np.sin(theta / 2.)
     return SingleQubitGate(a, -b, b, a,
-                           _notCheck=True, name=f"Ry({theta:.4f})")
+                           _notCheck=True, name=f"Ry({angleName(theta)})")
 
 
 def Rz(theta: float) -> SingleQubitGate:
     a = np.cos(theta / 2.)
     b = 1j * np.sin(theta / 2.)
     return SingleQubitGate(a - b, 0., 0., a + b,
-                           _notCheck=True, name=f"Rz({theta:.4f})")
+                           _notCheck=True, name=f"Rz({angleName(theta)})")
 
 
 def R1(theta: float) -> SingleQubitGate:
     """|1❭相位旋转门, 实际上 R1(theta) = Phase(theta/2) @ Rz(theta)"""
     return SingleQubitGate(1., 0., 0., np.exp(1j * theta),
-                           _notCheck=True, name=f"R1({theta:.4f})")
+                           _notCheck=True, name=f"R1({angleName(theta)})")
 
 
 def Phase(theta: float) -> SingleQubitGate:
     ph = np.exp(1j * theta)
     return SingleQubitGate(ph, 0., 0., ph,
-                           _notCheck=True, name=f"Ph({theta:.4f})")
+                           _notCheck=True, name=f"Ph({angleName(theta)})")
 
 
 class RotationGates:
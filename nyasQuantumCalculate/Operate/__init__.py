@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from .Circuit import *
 from .QFT import *
 from .Swap import *
 from .ControlMethod import *
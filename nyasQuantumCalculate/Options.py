@@ -16,7 +16,37 @@ class _options:
 
     Attributes:
         autoNormalize: 自动在作用位门后归一化系统 [default: True]
+        lazyNormalize:
+            autoNormalize开启时, 作用位门后只累计范数误差的上界, 等误差超过
+            Utils.delta, 或者读取states和移除量子位时才归一化 [default: True]
         allowTracking: 跟踪量子位系统的每一个操作 [default: False]
+        fuseGates:
+            单量子位门(包括受控的)先与等待中的位门相乘, 等到有其他操作用到这些
+            量子位(测量, QFT, 读取states等)时才作用到系统上. 直接读取statesNd
+            前需要调用`qbsys.flushGates()` [default: False]
+        fuseQubits:
+            fuseGates开启时, 一个等待中的位门最多作用在多少个量子位上. 为1时只
+            合并同一量子位上不受控的位门, 较大时受控门(如CNOT, CCNOT)和作用在
+            不同量子位上的位门也会合并为一个稠密矩阵 [default: 1]
+        compactRun:
+            SWAP只交换量子位与轴的对应关系. 移除量子位后, 如果系统在内存里
+            最内层连续的一段少于compactRun个元素, 就把系统复制为连续的数组,
+            为0时不自动整理 [default: 4096]
+        localityWindow:
+            大于0时, 重放Circuit和进入受控过程时按接下来(或跟踪器里最近)的
+            localityWindow个操作重新排列系统的轴, 让经常作用的量子位位于步长
+            大的轴上, 见`QubitsSystem.relayout` [default: 0]
+        blockQubits:
+            大于0时, 重放Circuit时连续的位门会按statesNd最后blockQubits个轴
+            分块作用, 每一块作用完全部位门才处理下一块. 块应该能放进CPU的缓存,
+            复数双精度的系统通常取14到16 [default: 0]
+        nThreads:
+            大于1时, 位门, 归一化, 测量和QFT会把较大的系统沿不参与运算的轴
+            分块, 在有nThreads个线程的线程池里同时处理, 见
+            `QubitsSystem.mapChunks` [default: 1]
+        addByPermutation:
+            跟踪关闭时, Adder, Add, IAdd, AddInt和IAddInt直接置换寄存器的
+            基态, 而不是使用临时量子位或者QFT和相位门 [default: True]
         littleEndian: 小端模式 [default: False]
         QFTwithNumpy: 使用numpy而不是位门实现QFT [default: True]
         checkCleaningSystem: 清除系统时检查系统是否已被重置 [default: True]
@@ -39,7 +69,15 @@ class _options:
     """
     def __init__(self) -> None:
         self.autoNormalize = True
+        self.lazyNormalize = True
         self.allowTracking = False
+        self.fuseGates = False
+        self.fuseQubits = 1
+        self.compactRun = 4096
+        self.localityWindow = 0
+        self.blockQubits = 0
+        self.nThreads = 1
+        self.addByPermutation = True
         self.littleEndian = False
         self.QFTwithNumpy = True
         self.checkCleaningSystem = True
@@ -52,7 +90,7 @@ Options = _options()
 
 class TempOption:
     """see more: help(TemporaryOptions)"""
-    def __init__(self, option: str, after: bool) -> None:
+    def __init__(self, option: str, after: Any) -> None:
         Options.__getattribute__(option)
         self.option = option
         self._after = after
@@ -85,10 +123,42 @@ class TemporaryOptions:
     def autoNormalize(after: bool) -> TempOption:
         return TempOption("autoNormalize", after)
 
+    @staticmethod
+    def lazyNormalize(after: bool) -> TempOption:
+        return TempOption("lazyNormalize", after)
+
     @staticmethod
     def allowTracking(after: bool) -> TempOption:
         return TempOption("allowTracking", after)
 
+    @staticmethod
+    def fuseGates(after: bool) -> TempOption:
+        return TempOption("fuseGates", after)
+
+    @staticmethod
+    def fuseQubits(after: int) -> TempOption:
+        return TempOption("fuseQubits", after)
+
+    @staticmethod
+    def compactRun(after: int) -> TempOption:
+        return TempOption("compactRun", after)
+
+    @staticmethod
+    def localityWindow(after: int) -> TempOption:
+        return TempOption("localityWindow", after)
+
+    @staticmethod
+    def blockQubits(after: int) -> TempOption:
+        return TempOption("blockQubits", after)
+
+    @staticmethod
+    def nThreads(after: int) -> TempOption:
+        return TempOption("nThreads", after)
+
+    @staticmethod
+    def addByPermutation(after: bool) -> TempOption:
+        return TempOption("addByPermutation", after)
+
     @staticmethod
     def littleEndian(after: bool) -> TempOption:
         return TempOption("littleEndian", after)
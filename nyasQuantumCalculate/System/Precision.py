@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+from typing import Any, Callable
+
+import numpy as np
+
+from .QubitsSystem import *
+
+
+__all__ = ["CheckPrecision"]
+
+
+def CheckPrecision(func: Callable[[QubitsSystem], Any], nQubits: int,
+                   dtype: Any = np.complex64, seed: int = 0) -> float:
+    """检查低精度系统的误差
+
+    分别在dtype和np.complex128的系统上运行func, 然后比较两者最后的状态. 两次
+    运行使用相同的随机数种子, 所以测量结果一般会相同. 因为需要额外一个双精度
+    的系统, 只应该在较小的系统上使用.
+
+    To use:
+    >>> def circuit(qbsys: QubitsSystem) -> None:
+    ...     ApplyToEach(Rx(0.3), qbsys.getQubits())
+    ...     Builtin.QFT(qbsys.getQubits())
+    ...
+    >>> CheckPrecision(circuit, 10)
+    1.0325656774274088e-08
+
+    Args:
+        func: 作用在量子位系统上的过程, 输入参数为量子位系统
+        nQubits: 系统的量子位数量
+        dtype: 需要检查的数据类型
+        seed: 随机数种子
+
+    Returns:
+        两个系统最后状态之差的最大绝对值"""
+    randomState = np.random.get_state()
+    results = list()
+    for dt in (dtype, np.complex128):
+        qbsys = QubitsSystem(nQubits, dt)
+        np.random.seed(seed)
+        func(qbsys)
+        results.append(qbsys.states.astype(np.complex128))
+        qbsys.restart()
+    np.random.set_state(randomState)
+    return float(np.max(np.abs(results[0] - results[1])))
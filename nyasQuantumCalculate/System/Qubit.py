@@ -52,9 +52,12 @@ class Qubit:
 class TemporaryQubit:
     """TemporaryQubit(QubitsSystem)
 
-    配合with语句产生临时的Qubit对象, 临时Qubit的内存块在with退出时会被销毁. 在
+    配合with语句产生临时的Qubit对象, 临时Qubit在with退出时会被释放. 在
     使用完临时Qubit后记得释放临时Qubit对象, 否则可能会引起不必要的错误.
 
+    临时量子位由`QubitsSystem.allocQubits`分配, 会重复使用系统预留的空间和
+    已经释放的量子位, 多个临时量子位可以不按分配的相反顺序释放.
+
     To use:
     >>> qbsys = QubitsSystem(4)
     >>> qbsys.nQubits
@@ -72,11 +75,11 @@ class TemporaryQubit:
         self.system = qbsys
 
     def __enter__(self) -> Qubit:
-        self.system.addQubits(1)
-        return Qubit(self.system, self.system.nQubits - 1)
+        self.index, = self.system.allocQubits(1)
+        return Qubit(self.system, self.index)
 
     def __exit__(self, *error: Any) -> None:
-        self.system.popQubits(1)
+        self.system.releaseQubits(self.index)
 
 
 ###############################################################################
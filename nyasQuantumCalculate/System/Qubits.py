@@ -78,9 +78,12 @@ class Qubits:
 class TemporaryQubits:
     """TemporaryQubits(QubitsSystem, int)
 
-    配合with语句产生临时的Qubits对象, 临时Qubits的内存块在with退出时会被销毁. 在
+    配合with语句产生临时的Qubits对象, 临时Qubits在with退出时会被释放. 在
     使用完临时Qubits后记得释放临时Qubits对象, 否则可能会引起不必要的错误.
 
+    与`TemporaryQubit`相同, 临时量子位会重复使用系统预留的空间, 见
+    `QubitsSystem.reserveQubits`.
+
     To use:
     >>> qbsys = QubitsSystem(4)
     >>> qbsys.nQubits
@@ -98,12 +101,11 @@ class TemporaryQubits:
         self.nQubits = nQubits
 
     def __enter__(self) -> Qubits:
-        self.system.addQubits(self.nQubits)
-        return Qubits(self.system, *range(self.system.nQubits - self.nQubits,
-                                          self.system.nQubits))
+        self.indexes = self.system.allocQubits(self.nQubits)
+        return Qubits(self.system, *self.indexes)
 
     def __exit__(self, *error: Any) -> None:
-        self.system.popQubits(self.nQubits)
+        self.system.releaseQubits(*self.indexes)
 
 
 ###############################################################################
@@ -1,16 +1,39 @@
 # -*- coding: utf-8 -*-
 
-from typing import List, Tuple, Union, Any
+from typing import (Dict, Iterator, List, Optional, Sequence, Tuple, Union,
+                    Any, Callable)
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+import tempfile
+import threading
 
 import numpy as np
 
 from nyasQuantumCalculate.Options import *
 from nyasQuantumCalculate.Utils import *
+from nyasQuantumCalculate import Utils
 
 
 __all__ = ["QubitsSystem"]
 
 
+# 元素少于这个数量的数组不并行处理, 线程调度的开销会超过计算本身
+_minParallelSize = 1 << 15
+_executor: Optional[ThreadPoolExecutor] = None
+_executorThreads = 0
+
+
+def getExecutor() -> ThreadPoolExecutor:
+    """得到有Options.nThreads个线程的线程池, 线程数改变时重新创建"""
+    global _executor, _executorThreads
+    if _executor is None or _executorThreads != Options.nThreads:
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = ThreadPoolExecutor(Options.nThreads)
+        _executorThreads = Options.nThreads
+    return _executor
+
+
 class id_manager:
     _last_id = -1
 
@@ -21,14 +44,48 @@ class id_manager:
 
 
 class QubitsSystem:
-    """QubitsSystem(nQubits)
+    """QubitsSystem(nQubits, dtype, memmapDir)
 
     用于储存和模拟量子位系统的类, 注意这个类不能被量子位过程(QubitsOperation)作用.
 
+    dtype可以为np.complex128(默认)或np.complex64, 单精度的系统只需要一半内存,
+    位门运算也更快, 但精度只有1e-7左右. 可以使用`CheckPrecision`在较小的系统
+    上检查单精度带来的误差.
+
+    dtype也可以为实数类型np.float64或np.float32, 只使用实数位门(如H, X, Z, Ry,
+    CNOT)的过程只需要复数系统一半的内存. 第一次作用含有复数的位门(如Y, S, T,
+    R1, QFT)时, 系统会自动转为相应精度的复数类型.
+
+    给出memmapDir时, 系统状态会储存在该文件夹下的临时文件里(np.memmap), 而不是
+    内存里, 这时量子位数量只受磁盘空间限制. 位门, 测量, 重置和QFT都会按chunkSize
+    分块处理状态, 每一块都是文件里连续的若干页, 临时数组也只有一块的大小.
+
+    给出batchSize时, 系统包含batchSize个互相独立的成员, statesNd的第一个轴为
+    成员的轴. 位门, 控制, QFT, 测量和重置都对全部成员一起作用, 参数为数组的
+    旋转门(如`Rx(np.linspace(0, pi, batchSize))`)对每个成员使用各自的参数.
+    测量返回每个成员结果组成的数组, states的形状为 (batchSize, 2^n, 1).
+
+    系统可以预留量子位(见`reserveQubits`), 临时量子位会使用预留的空间, 分配和
+    释放时不需要复制系统. 被释放但还不能移除的临时量子位记录在freeQubits里.
+
+    量子位与statesNd的轴的对应关系不是固定的, SWAP只交换两个量子位对应的轴,
+    不移动数据. 只有在移除量子位后系统在内存里不够连续时才会整理系统, 见
+    `compactStates`和`Options.compactRun`.
+
     退出程序或释放QubitsSystem实例前需要重置整个系统
 
     Attributes:
         stopTracking: 设置为False后, 就算allowTracking为True都不会继续跟踪操作.
+        normError:
+            上次归一化后累计的范数误差上界, 见`Options.lazyNormalize`. 自行归一化
+            系统的操作(如测量)可以把它设为0.
+        memmapDir: 储存系统状态的文件夹, 为None时系统状态在内存里
+        chunkSize:
+            分块处理状态时每一块最多的元素数量, 为None时不分块. 使用memmap时
+            默认为2^20, 否则默认为None
+        batchSize: 成员的数量, 为None时系统没有成员的轴
+        nReservedQubits: 预留量子位的数量
+        freeQubits: 已经被释放, 可以重新分配的量子位的索引
 
     To use:
     >>> qbsys = QubitsSystem(2)
@@ -43,44 +100,99 @@ class QubitsSystem:
         [0.+0.j]])
     """
 
-    def __init__(self, nQubits: int) -> None:
-        self.statesNd = np.zeros([2] * nQubits, np.complex128)
-        self.statesNd.__setitem__((*([0] * nQubits),), 1.)
+    def __init__(self, nQubits: int, dtype: Any = np.complex128,
+                 memmapDir: Optional[str] = None,
+                 batchSize: Optional[int] = None) -> None:
+        if np.dtype(dtype) not in (np.complex64, np.complex128,
+                                   np.float32, np.float64):
+            raise ValueError(f"Unsupported dtype '{np.dtype(dtype)}'.")
+        if batchSize is not None and batchSize < 1:
+            raise ValueError(f"Invalid batch size {batchSize}.")
+        self.memmapDir = memmapDir
+        self.chunkSize: Optional[int] = None if memmapDir is None else 1 << 20
+        self.batchSize = batchSize
+        self._nBatch = 0 if batchSize is None else 1
+        # statesNd是_pool里预留量子位全部为|0❭的部分, 见`reserveQubits`
+        self._nReserved = 0
+        self._pool = self.allocPool(nQubits, 0, dtype)
+        self._freeQubits: List[int] = list()
+        # 每个量子位在statesNd里的轴(不包括成员的轴), SWAP只交换这里的值
+        self._axes = list(range(nQubits))
+        # 上次按跟踪器重新排列轴时跟踪器的长度, 见`planLayout`
+        self._plannedAt = 0
+        self.updateStates()
+        self.statesNd.__setitem__((..., *([0] * nQubits)), 1.)
         self._id = id_manager.getID()
         self._ctlBits: List[int] = list()
         self._ctlBitPkgs: List[List[int]] = list()
-        self._qIndex = list(range(self.nQubits))
-        self._qIndexR = list(range(self.nQubits))
+        # 每个控制位需要的值, 为False时控制位为|0❭的部分被作用
+        self._ctlValues: Dict[int, bool] = dict()
+        # 按控制位的轴和系统大小缓存的控制位索引, 见`controlIndex`
+        self._ctlIndexes: Dict[Tuple[Any, ...], Tuple[Any, ...]] = dict()
         self._tracker: List[Tuple[Tuple[int, ...],
                                   Tuple[int, ...], str]] = list()
         self.stopTracking = False
+        self.normError = 0.
+        # 按(slot, 线程)保存的临时数组, 见`getBuffer`
+        self._buffers: Dict[Tuple[int, int], np.ndarray] = dict()
+        self._pendingGates: Dict[int, Any] = dict()
+        # 正在录制这个系统的Circuit, 参考`CaptureCircuit`
+        self.recorder: Any = None
 
     def __del__(self) -> None:
         print(f"Cleaning up qubits system with id:{self._id} ...")
+        self.flushGates()
+        # 退出程序时numpy可能已经不能导入模块(如导入过multiprocessing时),
+        # 所以使用ufunc的reduce而不是np.all
         if Options.checkCleaningSystem and \
-                not equal0(np.abs(
-                    self.statesNd.__getitem__((*([0] * self.nQubits),))
-                ) - 1.):
+                not np.logical_and.reduce(self.equal0(np.abs(
+                    self.statesNd.__getitem__((..., *([0] * self.nQubits)))
+                ) - 1.), axis=None):
             raise RuntimeError("Before cleaning up qubits system, "
                                "all qubits in system should be reset.")
 
     @property
-    def nQubits(self) -> int: return self.statesNd.ndim
+    def nQubits(self) -> int: return self.statesNd.ndim - self._nBatch
+
+    @property
+    def batchShape(self) -> Tuple[int, ...]:
+        return self.statesNd.shape[:self._nBatch]
+
+    @property
+    def nReservedQubits(self) -> int: return self._nReserved
+
+    @property
+    def freeQubits(self) -> Tuple[int, ...]: return tuple(self._freeQubits)
 
     @property
     def nControllingQubits(self) -> int: return len(self._ctlBits)
 
+    @property
+    def controllingQubits(self) -> Tuple[int, ...]: return tuple(self._ctlBits)
+
+    @property
+    def controlValues(self) -> Tuple[bool, ...]:
+        return tuple(self._ctlValues[idx] for idx in self._ctlBits)
+
     @property
     def id(self) -> int: return self._id
 
+    @property
+    def dtype(self) -> np.dtype: return self.statesNd.dtype
+
     @property
     def states(self) -> np.ndarray:
         # shape of states should be (2^n, 1) (column vector)
-        indexes = self._qIndex[::-1] \
-            if Options.littleEndian else self._qIndex
-        return self.statesNd. \
-            transpose(indexes). \
-            reshape([-1, 1])
+        # 有成员的轴时为 (batchSize, 2^n, 1)
+        self.flushGates()
+        self.flushNormalize()
+        if Options.littleEndian:
+            states = self.transposeStates(list(range(self.nQubits))[::-1])
+        elif self._axes != sorted(self._axes):
+            states = self.transposeStates(list(range(self.nQubits)))
+        else:
+            states = self.statesNd
+        return states.reshape([*self.batchShape, -1, 1])
 
     def __str__(self) -> str:
         return f"QubitsSystem({self.nQubits})"
@@ -111,9 +223,112 @@ class QubitsSystem:
             (Qubit)可以被量子位过程作用的量子位"""
         raise NotImplementedError
 
+    def equal0(self, x: float) -> bool:
+        """按系统的精度判断x是否为0
+
+        双精度系统与`Utils.equal0`相同, 单精度系统会使用更宽的容差. x为数组
+        (如有成员的轴的系统里`squareSum`的结果)时逐个元素判断"""
+        return abs(x) <= max(Utils.delta, 1000. * np.finfo(self.dtype).eps)
+
+    def toComplex(self) -> None:
+        """把实数系统转为相同精度的复数系统, 如果已经是复数系统则什么也不做"""
+        if self.dtype.kind != 'c':
+            self.moveStates(self._nReserved,
+                            np.result_type(self.dtype, np.complex64))
+
     def normalize(self) -> None:
         """归一化系统"""
-        self.statesNd /= np.sqrt(sss(self.statesNd))
+        norm = np.sqrt(self.squareSum(self.statesNd))
+        self.mapChunks(lambda chunk: np.divide(chunk, norm, out=chunk),
+                       self.statesNd)
+        self.normError = 0.
+
+    def addNormError(self, error: float, nOps: int = 1) -> None:
+        """累计范数误差
+
+        在误差上界超过系统精度的容差时归一化系统, 见`Options.lazyNormalize`
+
+        Args:
+            error: 操作本身引入的范数误差上界, 不包括舍入误差
+            nOps: 作用了多少次操作, 每次都有舍入误差"""
+        self.normError += error + 4. * nOps * np.finfo(self.dtype).eps
+        if not self.equal0(self.normError):
+            self.normalize()
+
+    def afterUnitary(self, error: float, nOps: int = 1) -> None:
+        """作用酉操作后按`Options.autoNormalize`和`Options.lazyNormalize`
+        处理归一化
+
+        Args:
+            error: 操作本身引入的范数误差上界, 见`addNormError`
+            nOps: 作用了多少次操作"""
+        if not Options.autoNormalize:
+            return
+        if Options.lazyNormalize:
+            self.addNormError(error, nOps)
+        else:
+            self.normalize()
+
+    def flushNormalize(self) -> None:
+        """如果存在未处理的范数误差, 则归一化系统"""
+        if self.normError != 0.:
+            self.normalize()
+
+    def getPendingGates(self, *idxs: int) -> List[Any]:
+        """得到作用在idxs上的等待中的位门, 见`Options.fuseGates`
+
+        Args:
+            idxs: 量子位的索引, 为空时返回全部等待中的位门
+
+        Returns:
+            不重复的等待中的位门列表"""
+        gates: List[Any] = list()
+        for idx in idxs or list(self._pendingGates):
+            gate = self._pendingGates.get(idx)
+            if gate is not None and all(gate is not g for g in gates):
+                gates.append(gate)
+        return gates
+
+    def popPendingGates(self, *idxs: int) -> List[Any]:
+        """从等待队列里取出作用在idxs上的位门, 取出的位门不会作用到系统上
+
+        Args:
+            idxs: 量子位的索引, 为空时取出全部等待中的位门
+
+        Returns:
+            不重复的等待中的位门列表"""
+        gates = self.getPendingGates(*idxs)
+        for gate in gates:
+            for idx in gate.indexes:
+                del self._pendingGates[idx]
+        return gates
+
+    def pendGate(self, gate: Any) -> None:
+        """把位门加入等待队列, 见`Options.fuseGates`
+
+        gate需要有属性indexes(作用的量子位索引)和方法`apply(qbsys)`. 等待中的
+        位门是不受控的, 就算在控制位存在时作用也会作用在整个系统上. 每个量子位
+        上最多只有一个等待中的位门, 需要先用`popPendingGates`取出原有的位门.
+
+        Args:
+            gate: 等待作用的位门"""
+        for idx in gate.indexes:
+            self._pendingGates[idx] = gate
+
+    def flushGates(self, *idxs: int) -> None:
+        """把等待中的位门作用到系统上
+
+        任何直接读写statesNd的操作都应该先调用这个方法. 存在控制位时, 控制位
+        上等待中的位门也会被作用.
+
+        Args:
+            idxs: 量子位的索引, 为空时作用全部等待中的位门"""
+        if not self._pendingGates:
+            return
+        if idxs:
+            idxs = (*idxs, *self._ctlBits)
+        for gate in self.popPendingGates(*idxs):
+            gate.apply(self)
 
     def getTracker(self):
         """返回系统内记录步骤的对象
@@ -134,13 +349,16 @@ class QubitsSystem:
 
     def restart(self) -> None:
         self.statesNd *= 0.
-        self.statesNd.__setitem__((*([0] * self.nQubits),), 1.)
+        self.statesNd.__setitem__((..., *([0] * self.nQubits)), 1.)
         self._ctlBits.clear()
         self._ctlBitPkgs.clear()
-        self._qIndex = list(range(self.nQubits))
-        self._qIndexR = list(range(self.nQubits))
+        self._ctlValues.clear()
         self._tracker.clear()
+        self._plannedAt = 0
         self.stopTracking = False
+        self.normError = 0.
+        self._buffers.clear()
+        self._pendingGates.clear()
 
     # TODO def isEntangled(self, idx: int) -> bool:
 
@@ -172,36 +390,14 @@ class QubitsSystem:
 
     ####################  Related to controlling qubits  ######################
 
-    def checkQuickIndexCorrect(self) -> bool:
-        """检查内部快速索引是否正常
-
-        没有实际用途, 只在 DEBUG 时会用上."""
-        if len(self._qIndex) != self.statesNd.ndim:
-            return False
-        if len(self._qIndex) != len(self._qIndexR):
-            return False
-        if not all(idx0 == idx1
-                   for idx0, idx1 in
-                   zip(self._ctlBits, self._qIndexR[-len(self._ctlBits):])):
-            return False
-        for (idx0, idxx0), (idx1, idxx1) in zip(
-            enumerate(self._qIndex),
-            enumerate(self._qIndexR)
-        ):
-            if self._qIndex[idxx1] != idx1:
-                return False
-            if self._qIndexR[idxx0] != idx0:
-                return False
-        return True
-
     def isControlling(self, idx: int) -> bool:
         return idx in self._ctlBits
 
     def statesNdIndex(self, idx: int, reverse: bool = False) -> int:
         """内部数组的索引
 
-        当存在控制位时, 内部数组的索引与量子位索引不一致, 这个
-        方法是用于得到正确的索引的. 无论在什么时候都没必要调用这个方法
+        量子位与statesNd的轴的对应关系由SWAP和移除量子位改变, 存在成员的轴
+        时索引还需要偏移.
 
         Args:
             idx: 量子位的索引, 应该从0开始到nQubits-1.
@@ -209,15 +405,14 @@ class QubitsSystem:
 
         Returns:
             索引"""
+        if reverse:
+            return self._axes.index(idx - self._nBatch)
         if not 0 <= idx < self.nQubits:
             raise ValueError(f"The qubit indexed {idx} does not exist.")
-        if not self._ctlBits:
-            return idx
-        if reverse:
-            return self._qIndexR[idx]
-        return self._qIndex[idx]
+        return self._axes[idx] + self._nBatch
 
-    def addControllingQubits(self, *idxs: int) -> None:
+    def addControllingQubits(self, *idxs: int,
+                             values: Optional[Sequence[bool]] = None) -> None:
         """增加一组控制位*
 
         用于多重控制的情况, 新增控制位不可以与已有控制位相同, 使用
@@ -226,12 +421,19 @@ class QubitsSystem:
         *请使用 `Controlled(opr, ctlQbs, ...)` 来控制过程
 
         Args:
-            idxs: 量子位的索引, 应该从0开始到nQubits-1"""
+            idxs: 量子位的索引, 应该从0开始到nQubits-1
+            values: 每个控制位需要的值, 默认全部为True"""
         if not idxs:
             return
         if any(idx in self._ctlBits for idx in idxs):
             raise ValueError("Controlling bit is added repeatedly.")
+        if values is None:
+            values = [True] * len(idxs)
+        elif len(values) != len(idxs):
+            raise ValueError("Each controlling bit needs one value.")
         self._ctlBitPkgs.append(list(idxs))
+        for idx, value in zip(idxs, values):
+            self._ctlValues[idx] = bool(value)
         self.updateControllingQubits()
 
     def popControllingQubits(self) -> None:
@@ -240,47 +442,325 @@ class QubitsSystem:
         删除最近添加的一组控制位"""
         if not self._ctlBitPkgs:
             return
-        self._ctlBitPkgs.pop()
+        for idx in self._ctlBitPkgs.pop():
+            del self._ctlValues[idx]
         self.updateControllingQubits()
 
-    def updateQuickIndex(self) -> None:
-        """更新快速索引
+    def transposeStates(self, order: List[int]) -> np.ndarray:
+        """按量子位的顺序转置statesNd, 成员的轴保持在最前
 
-        使用_ctlBits更新_qIndex和_qIndexR"""
-        if not self._ctlBitPkgs:
-            self._qIndex = list(range(self.nQubits))
-            self._qIndexR = list(range(self.nQubits))
-            return
-        self._qIndexR = [index for index in range(self.nQubits)
-                         if index not in self._ctlBits]
-        self._qIndexR += self._ctlBits
-        if len(self._qIndex) != self.nQubits:
-            self._qIndex = list(range(self.nQubits))
-        for index0, index1 in enumerate(self._qIndexR):
-            self._qIndex[index1] = index0
+        Args:
+            order: 转置后每个轴对应的量子位
+
+        Returns:
+            statesNd转置后的视图"""
+        return self.statesNd.transpose(
+            [*range(self._nBatch),
+             *(self._axes[index] + self._nBatch for index in order)])
+
+    def swapStates(self, idx0: int, idx1: int) -> None:
+        """交换两个量子位对应的轴, 只改变对应关系, 不移动或转置数据
+
+        Args:
+            idx0: 量子位的索引
+            idx1: 量子位的索引"""
+        axes = self._axes
+        axes[idx0], axes[idx1] = axes[idx1], axes[idx0]
 
     def updateControllingQubits(self) -> None:
         """更新控制位
 
-        使用_ctlBitPkgs来更新_ctlBits"""
-        if self._ctlBits:
-            self.statesNd = self.statesNd.transpose(self._qIndex)
+        使用_ctlBitPkgs来更新_ctlBits, 不会移动statesNd里的数据"""
         self._ctlBits.clear()
-        if not self._ctlBitPkgs:
-            self.updateQuickIndex()
-            return
         for pkg in self._ctlBitPkgs:
             self._ctlBits += pkg
         self._ctlBits.sort()
-        self.updateQuickIndex()
-        self.statesNd = self.statesNd.transpose(self._qIndexR)
+
+    def controlIndex(self) -> Tuple[Any, ...]:
+        """statesNd里控制位全部符合需要的值的部分的索引
+
+        控制位的轴使用长度为1的切片, 所以得到的视图的轴与statesNd一一对应.
+        结果按控制位的轴和系统大小缓存, 进入和退出受控过程不需要移动数据.
+
+        Returns:
+            长度为statesNd.ndim的索引"""
+        axes = tuple(self._axes[ctl] for ctl in self._ctlBits)
+        key = (axes, self.controlValues, self.statesNd.ndim)
+        index = self._ctlIndexes.get(key)
+        if index is None:
+            indexList: List[Any] = [slice(None)] * self.statesNd.ndim
+            for axis, value in zip(axes, key[1]):
+                indexList[axis + self._nBatch] = \
+                    slice(int(value), int(value) + 1)
+            index = self._ctlIndexes[key] = tuple(indexList)
+        return index
+
+    #########################  Related to kernels  ###########################
+
+    def splitStates(self, idx: int, controlled: bool = True) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """得到受控子空间里目标位为|0❭和|1❭的两半状态
+
+        返回的是statesNd的视图, 对其原地修改即修改系统状态. 当存在控制位时,
+        只包含控制位全部为1的部分.
+
+        Args:
+            idx: 目标量子位的索引, 应该从0开始到nQubits-1
+            controlled: 为False时无视控制位, 返回整个系统的两半状态
+
+        Returns:
+            目标位为|0❭的状态视图, 目标位为|1❭的状态视图"""
+        if controlled and self._ctlBits:
+            index = list(self.controlIndex())
+        else:
+            index = [slice(None)] * self.statesNd.ndim
+        axis = self.statesNdIndex(idx)
+        index[axis] = 0
+        s0 = self.statesNd.__getitem__((*index, ...))
+        index[axis] = 1
+        return s0, self.statesNd.__getitem__((*index, ...))
+
+    def splitStatesAt(self, idx: int, ctls: Tuple[int, ...],
+                      values: Optional[Tuple[bool, ...]] = None) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """类似`splitStates`, 但使用给定的控制位而不是系统里的控制位
+
+        Args:
+            idx: 目标量子位的索引
+            ctls: 控制位的索引
+            values: 每个控制位需要的值, 默认全部为True
+
+        Returns:
+            目标位为|0❭的状态视图, 目标位为|1❭的状态视图"""
+        index: List[Any] = [slice(None)] * self.statesNd.ndim
+        for k, ctl in enumerate(ctls):
+            index[self.statesNdIndex(ctl)] = \
+                1 if values is None else int(values[k])
+        axis = self.statesNdIndex(idx)
+        index[axis] = 0
+        s0 = self.statesNd.__getitem__((*index, ...))
+        index[axis] = 1
+        return s0, self.statesNd.__getitem__((*index, ...))
+
+    def allocStates(self, shape: List[int], dtype: Any = None) -> np.ndarray:
+        """分配全为0的状态数组
+
+        使用memmap时, 数组储存在memmapDir下的临时文件里, 文件在数组释放后删除.
+
+        Args:
+            shape: 数组的形状
+            dtype: 数组的类型, 默认与系统相同
+
+        Returns:
+            全为0的数组"""
+        dtype = self.dtype if dtype is None else dtype
+        if self.memmapDir is None:
+            return np.zeros(shape, dtype)
+        with tempfile.TemporaryFile(dir=self.memmapDir) as file:
+            return np.memmap(file, dtype, "w+", shape=tuple(shape))
+
+    def iterChunks(self, *arrays: np.ndarray,
+                   keepAxes: Tuple[int, ...] = (),
+                   chunkSize: Optional[int] = None) \
+            -> Iterator[Tuple[np.ndarray, ...]]:
+        """把形状相同的数组以相同方式分块
+
+        优先在步长最大的轴上分块, 使每一块在内存(或文件)里尽量连续. 分块使用
+        长度为1的切片, 所以每一块的维数和轴的顺序都与原数组相同. 有成员的轴时,
+        数组的第一个轴必须是成员的轴, 并且不会被分开.
+
+        Args:
+            arrays: 形状相同的数组, 通常是statesNd的视图
+            keepAxes: 不可以被分开的轴
+            chunkSize: 每一块最多的元素数量, 默认为系统的chunkSize
+
+        Returns:
+            每次迭代返回各个数组相应的一块视图"""
+        arr0 = arrays[0]
+        if chunkSize is None:
+            chunkSize = self.chunkSize
+        if chunkSize is None or arr0.size <= chunkSize:
+            yield arrays
+            return
+        if self._nBatch:
+            keepAxes = (0, *keepAxes)
+        axes = sorted((axis for axis in range(arr0.ndim)
+                       if axis not in keepAxes),
+                      key=lambda axis: -abs(arr0.strides[axis]))
+        size = arr0.size
+        splitAxes: List[int] = list()
+        for axis in axes:
+            if size <= chunkSize:
+                break
+            splitAxes.append(axis)
+            size //= arr0.shape[axis]
+        index: List[Any] = [slice(None)] * arr0.ndim
+        for values in product(*(range(arr0.shape[axis])
+                                for axis in splitAxes)):
+            for axis, value in zip(splitAxes, values):
+                index[axis] = slice(value, value + 1)
+            yield tuple(arr.__getitem__(tuple(index)) for arr in arrays)
+
+    def mapChunks(self, func: Callable[..., Any], *arrays: np.ndarray,
+                  keepAxes: Tuple[int, ...] = ()) -> List[Any]:
+        """对数组的每一块调用func, 分块方式见`iterChunks`
+
+        Options.nThreads大于1并且数组足够大时, 数组会额外按线程数分块, 各块
+        在线程池里同时处理. numpy的运算会释放GIL, 所以func应该主要由numpy的
+        运算组成, 并且各块之间不能互相依赖, 临时数组请使用`getBuffer`.
+
+        Args:
+            func: 以各个数组相应的一块为参数的函数
+            arrays: 形状相同的数组, 通常是statesNd的视图
+            keepAxes: 不可以被分开的轴
+
+        Returns:
+            每一块的func的返回值, 顺序与`iterChunks`相同"""
+        nThreads = Options.nThreads
+        size = arrays[0].size
+        if nThreads <= 1 or size < _minParallelSize:
+            return [func(*chunks)
+                    for chunks in self.iterChunks(*arrays, keepAxes=keepAxes)]
+        # 块数多于线程数, 一个线程被占用时其他线程可以继续处理剩下的块
+        chunkSize = max(size // (4 * nThreads), 1)
+        if self.chunkSize is not None:
+            chunkSize = min(chunkSize, self.chunkSize)
+        return self.parallelMap(lambda chunks: func(*chunks), list(
+            self.iterChunks(*arrays, keepAxes=keepAxes, chunkSize=chunkSize)))
+
+    def parallelMap(self, func: Callable[[Any], Any],
+                    items: Sequence[Any]) -> List[Any]:
+        """Options.nThreads大于1时在线程池里对每一项调用func
+
+        Args:
+            func: 可以在多个线程里同时调用的函数
+            items: 互不依赖的参数
+
+        Returns:
+            每一项的func的返回值"""
+        if Options.nThreads <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        return list(getExecutor().map(func, items))
+
+    def applyKernel(self, kernel: Callable[..., None], m: np.ndarray,
+                    s0: np.ndarray, s1: np.ndarray) -> None:
+        """分块把单量子位门的核作用到s0, s1上, 见`mapChunks`
+
+        Args:
+            kernel: 单量子位门的核, 参数为 (m, s0, s1, qbsys)
+            m: 位门的矩阵
+            s0: 目标位为|0❭的部分
+            s1: 目标位为|1❭的部分"""
+        self.mapChunks(lambda c0, c1: kernel(m, c0, c1, self), s0, s1)
+
+    def squareSum(self, states: np.ndarray) -> Any:
+        """分块计算`Utils.sss(states)`, 避免产生和states一样大的临时数组
+
+        有成员的轴时, 返回每个成员的结果, 形状为 (batchSize, 1, ...), 可以
+        直接与states广播"""
+        if not self._nBatch:
+            return sum(self.mapChunks(sss, states))
+        axes = tuple(range(1, states.ndim))
+        return sum(self.mapChunks(lambda chunk: np.sum(
+            np.square(np.abs(chunk)), axis=axes, keepdims=True), states))
+
+    def getBuffer(self, shape: Tuple[int, ...], slot: int = 0) -> np.ndarray:
+        """得到可重复使用的临时数组
+
+        每个slot只保留一块足够大的内存, 避免位门每次作用都分配新的临时数组.
+        同一slot的数组在下次调用时会被覆盖. 不同线程得到不同的数组, 所以
+        `mapChunks`里的各块可以同时使用同一slot.
+
+        Args:
+            shape: 临时数组的形状
+            slot: 临时数组的编号, 同时需要多个临时数组时使用不同的编号
+
+        Returns:
+            未初始化的数组, 类型与statesNd相同"""
+        size = 1
+        for length in shape:
+            size *= length
+        key = (slot, threading.get_ident())
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.size < size or \
+                buffer.dtype != self.dtype:
+            buffer = np.empty(size, self.dtype)
+            self._buffers[key] = buffer
+        return buffer[:size].reshape(shape)
 
     #####################  Related to temporary qubit  ########################
 
+    def allocPool(self, nQubits: int, nReserved: int,
+                  dtype: Any = None) -> np.ndarray:
+        """分配有nReserved个预留量子位的数组
+
+        预留量子位的轴在返回的视图的末端, 但在内存里步长最大, 所以预留量子位
+        全部为|0❭的部分是数组开头连续的一块, 先被使用的预留量子位步长最小.
+
+        Args:
+            nQubits: 量子位的数量
+            nReserved: 预留量子位的数量
+            dtype: 数组的类型, 默认与系统相同
+
+        Returns:
+            形状为 [*batchShape] + [2] * (nQubits + nReserved) 的全为0的视图"""
+        nBatch = self._nBatch
+        pool = self.allocStates(
+            [self.batchSize] * nBatch + [2] * (nReserved + nQubits), dtype)
+        return pool.transpose(
+            [*range(nBatch), *range(nBatch + nReserved, pool.ndim),
+             *range(nBatch + nReserved - 1, nBatch - 1, -1)])
+
+    def updateStates(self) -> None:
+        """由_pool和预留量子位的数量更新statesNd"""
+        self.statesNd = self._pool.__getitem__(
+            (..., *([0] * self._nReserved)))
+
+    def moveStates(self, nReserved: int, dtype: Any = None,
+                   order: Optional[Sequence[int]] = None) -> None:
+        """把系统状态复制到有nReserved个预留量子位的新数组里
+
+        新的statesNd是C顺序连续的, 它的轴按order排列, 并相应地更新量子位与
+        轴的对应关系. 默认保持原来的步长顺序, 所以后分配的临时量子位的步长
+        仍然较大, 释放后剩下的部分是连续的一块.
+
+        Args:
+            nReserved: 预留量子位的数量
+            dtype: 新数组的类型, 默认与系统相同
+            order: statesNd里从第一个轴开始依次对应的量子位"""
+        if order is None:
+            order = self.axisOrder()
+        pool = self.allocPool(self.nQubits, nReserved, dtype)
+        pool.__setitem__((..., *([0] * nReserved)),
+                         self.transposeStates(list(order)))
+        self._pool = pool
+        self._nReserved = nReserved
+        for axis, idx in enumerate(order):
+            self._axes[idx] = axis
+        self.updateStates()
+
+    def reserveQubits(self, nQubits: int) -> None:
+        """设置预留量子位的数量
+
+        预留量子位在系统状态的数组里占有空间但不属于系统, 并且总是|0❭.
+        `addQubits`会优先使用预留量子位, 只需要得到新的视图而不需要复制系统,
+        `popQubits`移除的量子位会回到预留量子位里. 预留nQubits个量子位需要
+        2^nQubits倍的内存, 在使用大量临时量子位前预留可以避免反复复制系统,
+        设为0则释放预留的内存.
+
+        Args:
+            nQubits: 预留量子位的数量"""
+        if nQubits < 0:
+            raise ValueError(f"Cannot reserve {nQubits} qubits.")
+        if nQubits != self._nReserved:
+            self.flushGates()
+            self.moveStates(nQubits)
+
     def addQubits(self, nQubits: int) -> None:
         """增加量子位*
 
-        在系统里增加nQubits个量子位, 并分配在其他量子位末端.
+        在系统里增加nQubits个量子位, 并分配在其他量子位末端. 预留量子位
+        不足时会先把预留量子位增加到nQubits个, 见`reserveQubits`.
 
         *请使用 `TemporaryQubit` 或 `TemporaryQubits` 分配临时量子位
 
@@ -290,20 +770,29 @@ class QubitsSystem:
             raise ValueError(f"Cannot add {nQubits} qubits.")
         if nQubits == 0:
             return
-        if self._ctlBits:
-            self.statesNd = self.statesNd.transpose(self._qIndex)
-        new_states = np.zeros([2] * (self.nQubits + nQubits), np.complex128)
-        new_states.__setitem__((..., *([0] * nQubits)), self.statesNd)
-        self.statesNd = new_states
-        self.updateQuickIndex()
-        if self._ctlBits:
-            self.statesNd = self.statesNd.transpose(self._qIndexR)
+        if self.recorder is not None:
+            self.recorder.addOperation("ADDQUBITS", (), (), nQubits)
+        # 等待中的位门在系统变大后再作用会更慢
+        self.flushGates()
+        if self._nReserved < nQubits:
+            self.moveStates(nQubits)
+        # 使用的预留量子位步长最大, 把它们移到statesNd的最前面, 使statesNd
+        # 保持C顺序
+        nBatch = self._nBatch
+        start = nBatch + self.nQubits
+        self._pool = self._pool.transpose(
+            [*range(nBatch), *range(start + nQubits - 1, start - 1, -1),
+             *range(nBatch, start), *range(start + nQubits, self._pool.ndim)])
+        self._axes = [axis + nQubits for axis in self._axes] + \
+            list(range(nQubits - 1, -1, -1))
+        self._nReserved -= nQubits
+        self.updateStates()
 
     def popQubits(self, nQubits: int) -> None:
         """移除量子位
 
         移除系统末端的nQubits个量子位, 量子位在被移除前需要被重置, 并且确保
-        被移除的量子位不是控制位
+        被移除的量子位不是控制位. 移除的量子位会成为预留量子位.
 
         Args:
             nQubits: 移除量子位的数量"""
@@ -311,16 +800,193 @@ class QubitsSystem:
             raise ValueError(f"Cannot pop {nQubits} qubits.")
         if nQubits == 0:
             return
-        if any(idx >= self.nQubits - nQubits for idx in self._ctlBits):
+        self.clearQubits(*range(self.nQubits - nQubits, self.nQubits))
+        if self.recorder is not None:
+            self.recorder.addOperation("POPQUBITS", (), (), nQubits)
+        self.dropQubits(nQubits)
+        self._freeQubits = [idx for idx in self._freeQubits
+                            if idx < self.nQubits]
+
+    def clearQubits(self, *idxs: int) -> None:
+        """检查量子位已经被重置, 并把它们不为|0❭的部分设为0
+
+        被重置的量子位不为|0❭的部分只有舍入误差, 设为0后它们可以直接成为
+        预留量子位.
+
+        Args:
+            idxs: 量子位的索引"""
+        if any(self.isControlling(idx) for idx in idxs):
             raise ValueError("The qubit removed is controlling qubit.")
-        if self._ctlBits:
-            self.statesNd = self.statesNd.transpose(self._qIndex)
-        states = self.statesNd.__getitem__((..., *([0] * nQubits)))
-        if not equal0(sss(states) - 1.):
-            if self._ctlBits:
-                self.statesNd = self.statesNd.transpose(self._qIndexR)
+        self.flushGates(*idxs)
+        self.flushNormalize()
+        index: List[Any] = [slice(None)] * self.statesNd.ndim
+        for idx in idxs:
+            index[self.statesNdIndex(idx)] = 0
+        states = self.statesNd.__getitem__(tuple(index))
+        if not np.all(self.equal0(self.squareSum(states) - 1.)):
             raise RuntimeError("The qubit removed is not reset.")
-        self.statesNd = states.copy()
-        self.updateQuickIndex()
-        if self._ctlBits:
-            self.statesNd = self.statesNd.transpose(self._qIndexR)
+        for idx in idxs:
+            index[self.statesNdIndex(idx)] = 1
+            self.mapChunks(lambda chunk: chunk.fill(0),
+                           self.statesNd.__getitem__(tuple(index)))
+            index[self.statesNdIndex(idx)] = 0
+
+    def allocQubits(self, nQubits: int) -> List[int]:
+        """分配临时量子位*
+
+        优先使用被`releaseQubits`释放但还没有移除的量子位, 不足时使用
+        `addQubits`增加量子位.
+
+        *请使用 `TemporaryQubit` 或 `TemporaryQubits` 分配临时量子位
+
+        Args:
+            nQubits: 临时量子位的数量
+
+        Returns:
+            临时量子位的索引, 全部为|0❭"""
+        if nQubits < 0:
+            raise ValueError(f"Cannot add {nQubits} qubits.")
+        idxs = self._freeQubits[:nQubits]
+        del self._freeQubits[:nQubits]
+        start = self.nQubits
+        self.addQubits(nQubits - len(idxs))
+        return idxs + list(range(start, self.nQubits))
+
+    def releaseQubits(self, *idxs: int) -> None:
+        """释放临时量子位*
+
+        量子位在被释放前需要被重置. 释放的顺序不需要与分配相反, 释放后位于
+        系统末端的量子位会被移除, 其余的量子位留在系统里(仍为|0❭), 之后由
+        `allocQubits`重新分配.
+
+        *请使用 `TemporaryQubit` 或 `TemporaryQubits` 分配临时量子位
+
+        Args:
+            idxs: 临时量子位的索引"""
+        if not idxs:
+            return
+        for idx in idxs:
+            if idx in self._freeQubits:
+                raise ValueError(f"The qubit indexed {idx} is released "
+                                 "repeatedly.")
+        self.clearQubits(*idxs)
+        self._freeQubits = sorted({*self._freeQubits, *idxs})
+        nFree = 0
+        while self.nQubits - 1 - nFree in self._freeQubits:
+            nFree += 1
+        if nFree:
+            if self.recorder is not None:
+                self.recorder.addOperation("POPQUBITS", (), (), nFree)
+            self.dropQubits(nFree)
+            del self._freeQubits[len(self._freeQubits) - nFree:]
+
+    def dropQubits(self, nQubits: int) -> None:
+        """把末端的nQubits个量子位变为预留量子位, 不检查它们是否被重置
+
+        SWAP之后被移除的量子位的轴可能在statesNd中间, 这里只转置_pool把它们
+        移到预留量子位里. 预留量子位按步长从小到大排列, 步长小的先被使用.
+        之后按`Options.compactRun`判断是否需要整理系统, 见`compactStates`.
+
+        Args:
+            nQubits: 移除量子位的数量"""
+        nBatch = self._nBatch
+        kept = self._axes[:self.nQubits - nQubits]
+        order = sorted(kept)
+        strides = self._pool.strides
+        reserved = sorted(
+            [*(axis + nBatch for axis in self._axes[len(kept):]),
+             *range(nBatch + self.nQubits, self._pool.ndim)],
+            key=lambda axis: abs(strides[axis]))
+        self._pool = self._pool.transpose(
+            [*range(nBatch), *(axis + nBatch for axis in order), *reserved])
+        self._axes = [order.index(axis) for axis in kept]
+        self._nReserved += nQubits
+        self.updateStates()
+        self.autoCompact()
+
+    def contiguousRun(self) -> int:
+        """statesNd在内存里最内层连续的一段有多少个元素
+
+        按步长从小到大累乘轴的长度, 直到遇到不连续的轴. statesNd没有空隙时
+        (无论轴的顺序)结果为整个数组的大小."""
+        states = self.statesNd
+        run = 1
+        for axis in sorted(range(states.ndim),
+                           key=lambda axis: abs(states.strides[axis])):
+            if states.shape[axis] == 1:
+                continue
+            if abs(states.strides[axis]) != run * states.itemsize:
+                break
+            run *= states.shape[axis]
+        return run
+
+    def compactStates(self, order: Optional[Sequence[int]] = None) -> None:
+        """整理系统
+
+        把系统状态复制到新的C顺序连续数组里, statesNd的轴按order排列, 并相应
+        地更新量子位与轴的对应关系. 预留量子位的数量不变.
+
+        Args:
+            order: statesNd里从第一个轴开始依次对应的量子位, 默认按量子位的
+                顺序, 即对应关系恢复为恒等"""
+        if order is None:
+            order = list(range(self.nQubits))
+        self.moveStates(self._nReserved, order=order)
+
+    def autoCompact(self) -> None:
+        """statesNd最内层连续的部分少于`Options.compactRun`个元素时整理系统"""
+        run = Options.compactRun
+        if run and self.contiguousRun() < min(run, self.statesNd.size):
+            # 使用`relayout`排列过的系统保持原来的步长顺序
+            self.compactStates(
+                self.axisOrder() if Options.localityWindow else None)
+
+    def axisOrder(self) -> List[int]:
+        """按statesNd里轴的步长从大到小排列的量子位"""
+        strides = self.statesNd.strides
+        return sorted(range(self.nQubits), key=lambda idx:
+                      -abs(strides[self.statesNdIndex(idx)]))
+
+    def relayout(self, idxs: Sequence[int]) -> bool:
+        """按接下来的操作的目标位重新排列statesNd的轴
+
+        numpy的位门在步长大的轴上更快(目标位为|0❭和|1❭的两半状态各自连续),
+        在步长小于`Options.compactRun`个元素的轴上会明显变慢. 这里统计每个
+        量子位在idxs里出现的次数, 把出现次数多的量子位放到步长大的轴上.
+        只有落在慢的轴上的操作减少至少4次(整理系统本身相当于几次位门)时才
+        会用`compactStates`移动数据.
+
+        Args:
+            idxs: 接下来的操作的目标位, 可以重复
+
+        Returns:
+            是否重新排列了系统"""
+        n = self.nQubits
+        counts = [0] * n
+        for idx in idxs:
+            if 0 <= idx < n:
+                counts[idx] += 1
+        current = self.axisOrder()
+        order = sorted(current, key=lambda idx: -counts[idx])
+        nFast = n - max(int(Options.compactRun).bit_length() - 1, 0)
+        saved = sum(counts[idx] for idx in current[nFast:]) - \
+            sum(counts[idx] for idx in order[nFast:])
+        if saved < 4:
+            return False
+        self.flushGates()
+        self.compactStates(order)
+        return True
+
+    def planLayout(self) -> None:
+        """按跟踪器里最近的`Options.localityWindow`个操作重新排列轴
+
+        跟踪器里最近的操作被当作接下来的操作的预测, 适用于重复执行相同
+        过程(如循环里的受控算术)的情况. 跟踪器每增加localityWindow个条目
+        才重新规划一次, 不能跟踪时什么也不做. 见`relayout`."""
+        window = Options.localityWindow
+        if not window or not self.canTrack() or \
+                len(self._tracker) - self._plannedAt < window:
+            return
+        self._plannedAt = len(self._tracker)
+        self.relayout([idx for _, idxs, _ in self._tracker[-window:]
+                       for idx in idxs])
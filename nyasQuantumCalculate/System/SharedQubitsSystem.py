@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import atexit
+import weakref
+
+import numpy as np
+
+from nyasQuantumCalculate.Utils import *
+from .QubitsSystem import *
+from .QubitsSystem import _minParallelSize
+
+
+__all__ = ["SharedQubitsSystem"]
+
+
+# 描述共享内存里的一个视图: (名字, 类型, 形状, 步长, 偏移的字节数)
+_Desc = Tuple[str, str, Tuple[int, ...], Tuple[int, ...], int]
+
+# multiprocessing只在使用SharedQubitsSystem时导入, 不影响普通的QubitsSystem
+
+# 工作进程当前附加的共享内存, 系统换用新的数组后旧的会被关闭
+_attached: Dict[str, Any] = dict()
+# 主进程创建的, 数组还没有被释放的共享内存. 共享内存只由数组的finalize
+# 引用, 不能在这里保留强引用, 否则模块被清理时共享内存会先于数组被关闭
+_created: Any = weakref.WeakValueDictionary()
+
+
+def _view(desc: _Desc) -> np.ndarray:
+    """在工作进程里由描述得到共享内存的视图"""
+    from multiprocessing import shared_memory
+    name, dtype, shape, strides, offset = desc
+    shm = _attached.get(name)
+    if shm is None:
+        for old in _attached.values():
+            old.close()
+        _attached.clear()
+        shm = shared_memory.SharedMemory(name)
+        _attached[name] = shm
+    return np.ndarray(shape, dtype, shm.buf, offset, strides)
+
+
+class _WorkerBuffers:
+    """在工作进程里代替QubitsSystem给核提供临时数组, 见`getBuffer`"""
+
+    def __init__(self) -> None:
+        self.dtype: Any = None
+        self._buffers: Dict[int, np.ndarray] = dict()
+
+    def getBuffer(self, shape: Tuple[int, ...], slot: int = 0) -> np.ndarray:
+        size = 1
+        for length in shape:
+            size *= length
+        buffer = self._buffers.get(slot)
+        if buffer is None or buffer.size < size or \
+                buffer.dtype != self.dtype:
+            buffer = np.empty(size, self.dtype)
+            self._buffers[slot] = buffer
+        return buffer[:size].reshape(shape)
+
+
+_workerBuffers = _WorkerBuffers()
+
+
+def _applyKernel(task: Tuple[Any, np.ndarray, _Desc, _Desc]) -> None:
+    kernel, m, desc0, desc1 = task
+    s0 = _view(desc0)
+    _workerBuffers.dtype = s0.dtype
+    kernel(m, s0, _view(desc1), _workerBuffers)
+
+
+def _squareSum(task: Tuple[_Desc, Optional[Tuple[int, ...]]]) -> Any:
+    desc, axes = task
+    if axes is None:
+        return sss(_view(desc))
+    return np.sum(np.square(np.abs(_view(desc))), axis=axes, keepdims=True)
+
+
+def _divide(task: Tuple[_Desc, Any]) -> None:
+    desc, norm = task
+    chunk = _view(desc)
+    np.divide(chunk, norm, out=chunk)
+
+
+def _release(shm: Any) -> None:
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        # 已经在退出程序时被删除
+        pass
+
+
+@atexit.register
+def _unlinkAll() -> None:
+    # 退出程序时系统可能还会被访问(如QubitsSystem.__del__), 只删除名字而不
+    # 解除映射, 内存在进程结束时释放
+    for shm in list(_created.values()):
+        shm.unlink()
+
+
+class SharedQubitsSystem(QubitsSystem):
+    """SharedQubitsSystem(nQubits, nProcesses, dtype, batchSize)
+
+    系统状态储存在共享内存(multiprocessing.shared_memory)里, 位门和归一化由
+    nProcesses个工作进程同时作用的量子位系统, 用于突破单个进程的内存带宽.
+    Qubit, Qubits和受控过程的用法与`QubitsSystem`完全相同.
+
+    每次作用位门时, 状态按不参与运算的步长最大的轴分为nProcesses块, 即最高的
+    log2(nProcesses)个量子位是全局量子位, 每个进程只作用在其中一种取值的
+    部分上. 位门的目标位是全局量子位时, 下一个量子位会代替它成为全局量子位,
+    因为各块都在同一段共享内存里, 不需要在进程之间交换数据. 测量, QFT和
+    多量子位的稠密矩阵仍然在主进程里计算(可以配合`Options.nThreads`).
+
+    工作进程在第一次作用足够大的位门时才启动. 在使用spawn启动进程的平台上
+    (Windows, macOS), 主程序需要放在 `if __name__ == "__main__":` 里.
+
+    Attributes:
+        nProcesses: 工作进程的数量
+
+    To use:
+    >>> qbsys = SharedQubitsSystem(24, 4)
+    >>> H(qbsys[0])
+    >>> M(qbsys[0])
+    True
+    """
+
+    def __init__(self, nQubits: int, nProcesses: int,
+                 dtype: Any = np.complex128,
+                 batchSize: Optional[int] = None) -> None:
+        if nProcesses < 1:
+            raise ValueError(f"Invalid number of processes {nProcesses}.")
+        self.nProcesses = nProcesses
+        self._executor: Any = None
+        # 共享内存的名字和它在主进程里的起止地址
+        self._blocks: Dict[str, Tuple[int, int]] = dict()
+        super().__init__(nQubits, dtype, None, batchSize)
+
+    def __del__(self) -> None:
+        try:
+            super().__del__()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+
+    def allocStates(self, shape: List[int], dtype: Any = None) -> np.ndarray:
+        """在共享内存里分配全为0的状态数组, 共享内存在数组释放后删除"""
+        from multiprocessing import shared_memory
+        dtype = np.dtype(self.dtype if dtype is None else dtype)
+        size = dtype.itemsize
+        for length in shape:
+            size *= length
+        # 新建的共享内存全为0
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        states = np.ndarray(shape, dtype, shm.buf)
+        start = states.__array_interface__["data"][0]
+        self._blocks[shm.name] = (start, start + size)
+        _created[shm.name] = shm
+        weakref.finalize(states, self._blocks.pop, shm.name, None)
+        weakref.finalize(states, _release, shm).atexit = False
+        return states
+
+    def describe(self, states: np.ndarray) -> Optional[_Desc]:
+        """得到工作进程可以用来重建states的描述
+
+        Returns:
+            states不在这个系统的共享内存里时返回None"""
+        address = states.__array_interface__["data"][0]
+        for name, (start, stop) in self._blocks.items():
+            if start <= address < stop:
+                return (name, states.dtype.str, states.shape,
+                        states.strides, address - start)
+        return None
+
+    def partition(self, *arrays: np.ndarray) -> Optional[List[List[_Desc]]]:
+        """把数组分为nProcesses块并得到每一块的描述, 见`iterChunks`
+
+        Returns:
+            数组太小或者不在共享内存里时返回None"""
+        if self.nProcesses <= 1 or arrays[0].size < _minParallelSize:
+            return None
+        result = list()
+        for chunks in self.iterChunks(
+                *arrays, chunkSize=max(arrays[0].size // self.nProcesses, 1)):
+            descs = [self.describe(chunk) for chunk in chunks]
+            if None in descs:
+                return None
+            result.append(descs)
+        return result
+
+    def runTasks(self, func: Callable[[Any], Any],
+                 tasks: List[Any]) -> List[Any]:
+        """在工作进程里对每一项调用func"""
+        from concurrent.futures import ProcessPoolExecutor
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.nProcesses)
+        return list(self._executor.map(func, tasks))
+
+    def applyKernel(self, kernel: Callable[..., None], m: np.ndarray,
+                    s0: np.ndarray, s1: np.ndarray) -> None:
+        """由工作进程分块作用单量子位门的核, 见`QubitsSystem.applyKernel`"""
+        parts = self.partition(s0, s1)
+        if parts is None:
+            return super().applyKernel(kernel, m, s0, s1)
+        self.runTasks(_applyKernel,
+                      [(kernel, m, desc0, desc1) for desc0, desc1 in parts])
+
+    def squareSum(self, states: np.ndarray) -> Any:
+        parts = self.partition(states)
+        if parts is None:
+            return super().squareSum(states)
+        axes = tuple(range(1, states.ndim)) if self._nBatch else None
+        return sum(self.runTasks(_squareSum,
+                                 [(desc, axes) for desc, in parts]))
+
+    def normalize(self) -> None:
+        parts = self.partition(self.statesNd)
+        if parts is None:
+            return super().normalize()
+        norm = np.sqrt(self.squareSum(self.statesNd))
+        self.runTasks(_divide, [(desc, norm) for desc, in parts])
+        self.normError = 0.
@@ -3,9 +3,11 @@
 from typing import Union as _U, List as _L
 
 from .Dump import *
+from .Precision import *
 from .Qubits import *
 from .Qubit import *
 from .QubitsSystem import *
+from .SharedQubitsSystem import *
 
 
 def inSameSystem(*args: _U[Qubit, Qubits, QubitsSystem]) -> bool:
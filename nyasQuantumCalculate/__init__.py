@@ -15,6 +15,8 @@ __all__ = [
     "PhaseAddInt", "IPhaseAddInt", "AddInt", "IAddInt",
     # .HighLevel.Modular
     #"PhaseModularAddInt", "ModularAddInt",
+    # .Operate.Circuit
+    "Circuit", "CaptureCircuit",
     # .Operate.ApplyMethod
     "ApplyToEach", "ApplyFromBools", "ApplyFromInt",
     # .Operate.ControlMethod
@@ -27,12 +29,16 @@ __all__ = [
     "inSameSystem", "isControllingQubits", "haveSameQubit",
     # .System.Dump
     "DumpSystemText", "DumpSystemFig", "have_matplotlib",
+    # .System.Precision
+    "CheckPrecision",
     # .System.Qubit
     "Qubit", "TemporaryQubit",
     # .System.Qubits
     "Qubits", "TemporaryQubits",
     # .System.QubitsSystem
     "QubitsSystem",
+    # .System.SharedQubitsSystem
+    "SharedQubitsSystem",
     # .Options
     "Options", "TemporaryOptions", "TempOption"
 ]
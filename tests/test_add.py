@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from typing import Callable
+
+import numpy as np
+
+from nyasQuantumCalculate import *
+from nyasQuantumCalculate.Builtin import *
+
+
+def prepare(qbsys: QubitsSystem, seed: int, superposed: bool) -> None:
+    rng = np.random.default_rng(seed)
+    for qb in qbsys.getQubits():
+        if superposed:
+            Ry(rng.uniform(0., np.pi))(qb)
+            Rz(rng.uniform(0., np.pi))(qb)
+        elif rng.integers(2):
+            X(qb)
+
+
+def run(process: Callable[[QubitsSystem], None], seed: int,
+        superposed: bool, permutation: bool) -> np.ndarray:
+    qbsys = QubitsSystem(8)
+    prepare(qbsys, seed, superposed)
+    with TemporaryOptions.addByPermutation(permutation):
+        process(qbsys)
+    states = qbsys.states.copy()
+    RA(qbsys.getQubits())
+    return states
+
+
+def test_add_by_permutation() -> None:
+    processes = [
+        lambda qbsys: Adder(qbsys[0], qbsys.getQubits(1, 2, 3),
+                            qbsys.getQubits(4, 5, 6), qbsys[7]),
+        lambda qbsys: Add(qbsys.getQubits(1, 2),
+                          qbsys.getQubits(4, 5, 6, 7)),
+        lambda qbsys: IAdd(qbsys.getQubits(3, 1),
+                           qbsys.getQubits(7, 5, 4)),
+        lambda qbsys: AddInt(5, qbsys.getQubits(2, 4, 6)),
+        lambda qbsys: IAddInt(11, qbsys.getQubits(1, 3, 5, 7)),
+        lambda qbsys: Controlled(
+            lambda: Add(qbsys.getQubits(1, 2), qbsys.getQubits(4, 5, 6)),
+            qbsys.getQubits(0)),
+        lambda qbsys: Controlled(
+            lambda: IAddInt(3, qbsys.getQubits(4, 5, 6)),
+            qbsys.getQubits(0, 7)),
+    ]
+    for process in processes:
+        for seed in range(3):
+            for superposed in (False, True):
+                expected = run(process, seed, superposed, False)
+                result = run(process, seed, superposed, True)
+                assert np.allclose(result, expected)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from nyasQuantumCalculate import *
+from nyasQuantumCalculate.Builtin import *
+
+
+def prepare(qbsys: QubitsSystem) -> None:
+    for i, qb in enumerate(qbsys.getQubits()):
+        Ry(0.3 + 0.4 * i)(qb)
+        Rz(0.2 * i)(qb)
+
+
+def withTemporary(qbsys: QubitsSystem) -> None:
+    q0, q1, q2 = qbsys.getQubits(0, 1, 2)
+    H(q0)
+    with TemporaryQubit(qbsys) as t:
+        CNOT(q0, t)
+        Controlled(Ry(0.7), t.asQubits(), q1)
+        ControlledOnInt(X, 0, t.asQubits(), q2)
+        CNOT(q0, t)
+    CNOT(q2, q1)
+
+
+def narrow(qbsys: QubitsSystem) -> None:
+    q0, q1 = qbsys.getQubits(0, 1)
+    H(q1)
+    CNOT(q1, q0)
+    T(q0)
+
+
+def wide(qbsys: QubitsSystem) -> None:
+    q0, q1, q2, q3 = qbsys.getQubits(0, 1, 2, 3)
+    Controlled(Rx(1.1), q3.asQubits(), q0)
+    SWAP(q1, q2)
+    CNOT(q0, q3)
+
+
+def test_replay_temporary_qubits_on_larger_system() -> None:
+    small = QubitsSystem(3)
+    prepare(small)
+    with CaptureCircuit(small) as circuit:
+        withTemporary(small)
+    RA(small.getQubits())
+
+    replayed = QubitsSystem(4)
+    direct = QubitsSystem(4)
+    for qbsys in (replayed, direct):
+        prepare(qbsys)
+        X(qbsys[3])
+    circuit.replay(replayed)
+    withTemporary(direct)
+    assert replayed.nQubits == direct.nQubits == 4
+    assert np.allclose(replayed.states, direct.states)
+    RA(replayed.getQubits())
+    RA(direct.getQubits())
+
+
+def test_extend_with_wider_circuit() -> None:
+    small = QubitsSystem(2)
+    with CaptureCircuit(small) as first:
+        narrow(small)
+    RA(small.getQubits())
+    large = QubitsSystem(4)
+    with CaptureCircuit(large) as second:
+        wide(large)
+    RA(large.getQubits())
+
+    circuit = Circuit()
+    circuit.extend(first)
+    circuit.extend(second)
+    assert circuit.nQubits == 4
+
+    replayed = QubitsSystem(4)
+    direct = QubitsSystem(4)
+    for qbsys in (replayed, direct):
+        prepare(qbsys)
+    circuit.replay(replayed)
+    narrow(direct)
+    wide(direct)
+    assert np.allclose(replayed.states, direct.states)
+    RA(replayed.getQubits())
+    RA(direct.getQubits())
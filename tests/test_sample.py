@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from nyasQuantumCalculate import *
+from nyasQuantumCalculate.Builtin import *
+
+
+def test_sample_zero_shots() -> None:
+    qbsys = QubitsSystem(2)
+    qbs = qbsys.getQubits()
+    H(qbs[0])
+    assert Sample(qbs, 0).shape == (0,)
+    assert np.array_equal(Sample(qbs, 0, counts=True), np.zeros(4))
+    RA(qbs)
+    batch = QubitsSystem(2, batchSize=3)
+    assert Sample(batch.getQubits(), 0).shape == (3, 0)
+    assert np.array_equal(Sample(batch.getQubits(), 0, counts=True),
+                          np.zeros((3, 4)))